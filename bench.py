@@ -0,0 +1,204 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+import price_tools
+import tax_my_shit_up
+
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+PHASES = ['ingest', 'pricing', 'matching', 'output']
+BENCH_QUOTE_ASSETS = ['AUD', 'BTC']  # trades are made against these
+
+
+def asset_coverage():
+    """ Return a dict of asset -> (first, last) day ordinals on which every pair on its conversion path has a bar """
+    coverage = dict()
+    for asset in sorted(price_tools.get_conversion_graph()):
+        if asset == price_tools.PRICE_QUOTE_ASSET:
+            continue
+        try:
+            path = price_tools.get_conversion_path(asset)
+        except price_tools.PriceLookupError:
+            continue
+        series = [price_tools.get_pair_data(asset_pair) for asset_pair, inverted in path]
+        first = max(pair_series.first_ordinal for pair_series in series)
+        last = min(pair_series.first_ordinal + len(pair_series) - 1 for pair_series in series)
+        if first <= last:
+            coverage[asset] = (first, last)
+    return coverage
+
+
+def generate_trades(file_name, count, seed=0):
+    """ Write count synthetic trades to file_name in the input format, in date order. Deposits of AUD buy into the
+    assets priced on each day, holdings are traded between assets and against BTC, and sold back to AUD, never
+    selling more than is held. Dates run while at least half of the assets are priced, as a few pairs go back
+    years before the rest and trades outside that could only be between those few """
+    rng = random.Random(seed)
+    coverage = asset_coverage()
+    firsts = sorted(first for first, last in coverage.values())
+    lasts = sorted(last for first, last in coverage.values())
+    first, last = firsts[(len(firsts) - 1) // 2], lasts[len(lasts) // 2]
+    holdings = dict()
+    bought_today, today = dict(), None  # a lot can only be sold from the day after it is bought
+    with open(file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['date', 'buy_asset', 'buy_volume', 'sell_asset', 'sell_volume', 'fee_asset', 'fee_volume',
+                         'comment'])
+        for trade in range(count):
+            ordinal = first + (last - first) * trade // max(count - 1, 1)
+            if ordinal != today:
+                for asset, volume in bought_today.items():
+                    holdings[asset] = holdings.get(asset, 0) + volume
+                bought_today, today = dict(), ordinal
+            listed = [asset for asset, (asset_first, asset_last) in coverage.items()
+                      if asset_first <= ordinal <= asset_last]
+            held = [asset for asset in listed if holdings.get(asset, 0) > 0.001]
+            if not held or rng.random() < 0.4:
+                quotes = [asset for asset in BENCH_QUOTE_ASSETS if asset == 'AUD' or asset in held]
+                sell_asset = rng.choice(quotes)
+                buy_asset = rng.choice([asset for asset in listed if asset != sell_asset])
+            else:
+                sell_asset = rng.choice(held)
+                buy_asset = rng.choice([asset for asset in listed + ['AUD'] if asset != sell_asset])
+
+            if sell_asset != 'AUD':
+                sell_volume = holdings[sell_asset] * rng.uniform(0.05, 0.8)
+            else:
+                sell_volume = rng.uniform(10, 5000)
+            sell_price = float(price_tools.get_price_at_ordinal(sell_asset, ordinal))
+            buy_price = float(price_tools.get_price_at_ordinal(buy_asset, ordinal))
+            buy_volume = sell_volume * sell_price / buy_price if buy_price else 0
+            if buy_asset != 'AUD':
+                bought_today[buy_asset] = bought_today.get(buy_asset, 0) + buy_volume
+            if sell_asset != 'AUD':
+                holdings[sell_asset] -= sell_volume * 1.002  # the fee is paid in the sold asset too
+
+            date = datetime.date.fromordinal(ordinal).strftime("%d/%m/%Y")
+            writer.writerow([date, buy_asset, "%.8f" % buy_volume, sell_asset, "%.8f" % sell_volume, sell_asset,
+                             "%.8f" % (sell_volume * 0.002), "bench %s" % trade])
+
+
+class PhaseTimer:
+    """ Records the wall time and peak traced memory of each phase of a run """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = dict()
+
+    def measure(self, phase, trades, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results[phase] = {
+            'seconds': seconds,
+            'trades_per_second': trades / seconds if seconds else None,
+            'peak_bytes': tracemalloc.get_traced_memory()[1] if self.trace_memory else None,
+        }
+        return result
+
+
+def bench_size(trade_count, seed=0, workers=0, strategy="default", trace_memory=True):
+    """ Generate trade_count trades and time each phase of working them out. Price data is cleared first, so the
+    pricing phase includes loading the pairs it needs """
+    with tempfile.TemporaryDirectory() as folder:
+        input_dir = os.path.join(folder, "input")
+        os.makedirs(input_dir)
+        generate_trades(os.path.join(input_dir, "bench.csv"), trade_count, seed)
+        price_tools.clear_price_data()
+
+        timer = PhaseTimer(trace_memory)
+        if trace_memory:
+            tracemalloc.start()
+        try:
+            run = tax_my_shit_up.TaxRun(input_dir, os.path.join(folder, "output"))
+            timer.measure('ingest', trade_count, tax_my_shit_up.read_input_directory, run, run.input_dir, workers)
+            timer.measure('pricing', trade_count, tax_my_shit_up.price_input_records, run)
+            timer.measure('matching', trade_count, tax_my_shit_up.do_calc_gains, run, strategy, workers)
+            timer.measure('output', trade_count, tax_my_shit_up.write_all_output_files, run)
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+    return timer.results
+
+
+def compare_to_baseline(results, baseline, tolerance, min_seconds=0.0):
+    """ Return a list of messages for each phase which got slower, or used more memory, than baseline by more than
+    tolerance (a fraction). Times under min_seconds are compared as min_seconds, so scheduler noise on a phase
+    which takes a few milliseconds is not a regression """
+    regressions = list()
+    for size, phases in results['sizes'].items():
+        for phase, measured in phases.items():
+            expected = baseline['sizes'].get(size, {}).get(phase)
+            if expected is None:
+                continue
+            for measure in ['seconds', 'peak_bytes']:
+                if measured[measure] is None or not expected.get(measure):
+                    continue
+                if measure == 'seconds':
+                    ratio = max(measured[measure], min_seconds) / max(expected[measure], min_seconds)
+                else:
+                    ratio = measured[measure] / expected[measure]
+                if ratio > 1 + tolerance:
+                    regressions.append("%s trades, %s: %s is %.2fx the baseline (%.4g vs %.4g)" % (
+                        size, phase, measure, ratio, measured[measure], expected[measure]))
+    return regressions
+
+
+def print_results(results):
+    print("%10s %-9s %10s %14s %12s" % ("trades", "phase", "seconds", "trades/s", "peak MB"))
+    for size, phases in results['sizes'].items():
+        for phase in PHASES:
+            measured = phases[phase]
+            peak = "%.1f" % (measured['peak_bytes'] / 1e6) if measured['peak_bytes'] is not None else "-"
+            rate = "%.0f" % measured['trades_per_second'] if measured['trades_per_second'] else "-"
+            print("%10s %-9s %10.3f %14s %12s" % (size, phase, measured['seconds'], rate, peak))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time ingestion, pricing, matching and output on synthetic trades")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="trade counts to run")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic trade generator")
+    parser.add_argument("--workers", type=int, default=0, help="processes to parse input and match with")
+    parser.add_argument("--strategy", default="default", help="lot matching strategy")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows every phase down")
+    parser.add_argument("--save-baseline", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare the results with a baseline json file, failing on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slow down before a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="phase times below this are compared as this")
+    args = parser.parse_args()
+    # The default strategy leaves some early sells unmatched, and logging each of them would be timed as well
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'workers': args.workers,
+        'strategy': args.strategy,
+        'sizes': dict(),
+    }
+    for size in args.sizes:
+        results['sizes'][str(size)] = bench_size(size, args.seed, args.workers, args.strategy, not args.no_memory)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance,
+                                              args.min_seconds)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        sys.exit(1 if regressions else 0)
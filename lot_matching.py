@@ -0,0 +1,348 @@
+import heapq
+import bisect
+import datetime
+import collections
+import concurrent.futures
+from decimal import Decimal
+
+
+CGT_DISCOUNT_DAYS = 365  # assets held for more than this many days are eligible for the CGT discount
+Lot = collections.namedtuple('Lot', ['id', 'date', 'asset', 'price_aud', 'volume'])  # an open buy lot
+Sell = collections.namedtuple('Sell', ['id', 'date', 'asset', 'price_aud', 'volume'])  # a sell to match with lots
+
+
+def claim_volume(sell_remaining, lot_remaining):
+    """ Return the volume a sell claims from a lot, and what is left of each after it. Volumes are rounded like
+    calculate_taxable_event rounds them, so a strategy's claims replay onto the events exactly """
+    volume = min(sell_remaining, lot_remaining)
+    return volume, round(sell_remaining - volume, 4), round(lot_remaining - volume, 4)
+
+
+def days_held(sell_date, lot_date):
+    """ Whole calendar days between buying and selling. Times of day only change the price, so a lot bought at
+    10:00 and sold 366 days later at 09:00 is still held 366 days """
+    return (sell_date.date() - lot_date.date()).days
+
+
+def is_cgt_discounted(sell_date, lot_date):
+    return days_held(sell_date, lot_date) > CGT_DISCOUNT_DAYS
+
+
+class BuyLotIndex:
+    """ Open buy lots grouped by asset. The lots of each asset are sorted by date, so the lots bought before a sell
+    are found by bisection, and lots which have been fully claimed are unlinked from the index so later sells never
+    visit them again """
+    def __init__(self, lots, remaining):
+        self.remaining = remaining  # lot id -> unclaimed volume, a lot is open while this is not 0
+        self.lots = dict()  # asset -> list of Lot, sorted by date
+        self.dates = dict()  # asset -> list of the dates of those lots, for bisection
+        self.next_open = dict()  # asset -> next_open[i] leads to the first open lot at or after i
+        self.prev_open = dict()  # asset -> prev_open[i + 1] leads to the last open lot at or before i, 0 is none
+        for lot in sorted(lots, key=lambda lot: lot.date):
+            self.lots.setdefault(lot.asset, []).append(lot)
+
+        for asset, asset_lots in self.lots.items():
+            self.dates[asset] = [lot.date for lot in asset_lots]
+            self.next_open[asset] = list(range(len(asset_lots) + 1))
+            self.prev_open[asset] = list(range(len(asset_lots) + 1))
+
+    def open_lots(self, asset, cutoff, newest_first=False, inclusive=False):
+        """ Yield the open lots of asset bought before cutoff (or on cutoff, if inclusive) """
+        lots = self.lots.get(asset)
+        if not lots:
+            return
+
+        if inclusive:
+            end = bisect.bisect_right(self.dates[asset], cutoff)
+        else:
+            end = bisect.bisect_left(self.dates[asset], cutoff)
+
+        if newest_first:
+            prev_open = self.prev_open[asset]
+            position = _find_open(prev_open, end)
+            while position > 0:
+                lot = lots[position - 1]
+                if self.remaining[lot.id] != 0:
+                    yield lot
+                if self.remaining[lot.id] == 0:
+                    self.drop(asset, position - 1)
+                position = _find_open(prev_open, position - 1)
+        else:
+            next_open = self.next_open[asset]
+            position = _find_open(next_open, 0)
+            while position < end:
+                lot = lots[position]
+                if self.remaining[lot.id] != 0:
+                    yield lot
+                if self.remaining[lot.id] == 0:
+                    self.drop(asset, position)
+                position = _find_open(next_open, position + 1)
+
+    def drop(self, asset, position):
+        """ Unlink a claimed lot, so both walk directions skip over it """
+        self.next_open[asset][position] = position + 1
+        self.prev_open[asset][position + 1] = position
+
+
+def _find_open(pointers, position):
+    """ Follow pointers to the nearest open lot, compressing the path behind us """
+    root = position
+    while pointers[root] != root:
+        root = pointers[root]
+    while pointers[position] != root:
+        pointers[position], position = root, pointers[position]
+    return root
+
+
+class DefaultStrategy:
+    """ The original policy. Sells are matched latest first. Each sell takes lots held for more than 365 days,
+    newest of those first, so the discount is kept with the shortest hold, then any earlier lot, oldest first """
+    name = "default"
+
+    def __init__(self):
+        self.lots_scanned = 0  # open lots visited while matching, a measure of the matching work done
+
+    def match(self, lots, sells):
+        """ Return the (sell, lot, volume) claims for all sells """
+        remaining = {lot.id: lot.volume for lot in lots}
+        lot_index = BuyLotIndex(lots, remaining)
+        claims = list()
+        for sell in sorted(sells, key=lambda sell: sell.date)[::-1]:
+            sell_remaining = sell.volume
+            # Lots bought on or before the last day which gives a discount, at any time of that day
+            cgt_cutoff = datetime.datetime.combine(sell.date.date() - datetime.timedelta(days=CGT_DISCOUNT_DAYS),
+                                                   datetime.time())
+            lot_runs = [lot_index.open_lots(sell.asset, cgt_cutoff, newest_first=True),
+                        lot_index.open_lots(sell.asset, sell.date)]
+            for lot_run in lot_runs:
+                for lot in lot_run:
+                    self.lots_scanned += 1
+                    # Ignore the dust
+                    if sell_remaining == 0.0:
+                        break
+                    volume, sell_remaining, remaining[lot.id] = claim_volume(sell_remaining, remaining[lot.id])
+                    claims.append((sell, lot, volume))
+        return claims
+
+
+class HeapStrategy:
+    """ Base for strategies which match sells in date order, against a heap per asset of the lots bought before the
+    sell. The lot with the smallest lot_key is claimed first, so each claim costs O(log n) """
+    name = None
+
+    def __init__(self):
+        self.remaining = dict()  # lot id -> unclaimed volume
+        self.heaps = dict()  # asset -> heap of (lot_key, arrival, lot)
+        self.arrivals = 0  # lots are added in date order, so this orders them by date
+        self.lots_scanned = 0  # heap tops looked at while matching, claimed or popped
+
+    def lot_key(self, lot, arrival):
+        raise NotImplementedError
+
+    def add_lot(self, lot):
+        self.remaining[lot.id] = lot.volume
+        if lot.volume != 0:
+            self.push_lot(self.heaps.setdefault(lot.asset, []), lot, self.arrivals)
+        self.arrivals += 1
+
+    def push_lot(self, heap, lot, arrival):
+        heapq.heappush(heap, (self.lot_key(lot, arrival), arrival, lot))
+
+    def top_lot(self, heap):
+        """ Return the best open lot in heap, popping claimed lots off the top """
+        while heap and self.remaining[heap[0][2].id] == 0:
+            heapq.heappop(heap)
+            self.lots_scanned += 1
+        return heap[0][2] if heap else None
+
+    def best_lot(self, sell):
+        return self.top_lot(self.heaps.get(sell.asset, []))
+
+    def match_sell(self, sell):
+        """ Return the (sell, lot, volume) claims covering sell, as far as the open lots go """
+        claims = list()
+        sell_remaining = sell.volume
+        while sell_remaining != 0:
+            lot = self.best_lot(sell)
+            if lot is None:
+                break
+            self.lots_scanned += 1
+            volume, sell_remaining, self.remaining[lot.id] = claim_volume(sell_remaining, self.remaining[lot.id])
+            claims.append((sell, lot, volume))
+        return claims
+
+    def match(self, lots, sells):
+        return match_in_date_order([self], lots, sells)[self.name]
+
+
+class FifoStrategy(HeapStrategy):
+    """ First in, first out """
+    name = "fifo"
+
+    def lot_key(self, lot, arrival):
+        return arrival
+
+
+class LifoStrategy(HeapStrategy):
+    """ Last in, first out """
+    name = "lifo"
+
+    def lot_key(self, lot, arrival):
+        return -arrival
+
+
+class HifoStrategy(HeapStrategy):
+    """ Highest cost first, which keeps each gain as small as it can be """
+    name = "hifo"
+
+    def lot_key(self, lot, arrival):
+        return -lot.price_aud
+
+
+class MinTaxStrategy(HeapStrategy):
+    """ Claim whichever lot adds the least taxable gain per unit, counting the CGT discount. Lots sit in a heap of
+    recent lots, highest cost first, until they have been held long enough for the discount, when they move to a
+    second heap of discounted lots. Each claim compares the tops of the two """
+    name = "min-tax"
+
+    def __init__(self):
+        HeapStrategy.__init__(self)
+        self.waiting = dict()  # asset -> deque of lots in date order not yet eligible for the discount
+        self.discounted = dict()  # asset -> heap of lots eligible for the discount
+        self.discounted_ids = set()
+
+    def lot_key(self, lot, arrival):
+        return -lot.price_aud
+
+    def add_lot(self, lot):
+        arrival = self.arrivals
+        HeapStrategy.add_lot(self, lot)
+        if lot.volume != 0:
+            self.waiting.setdefault(lot.asset, collections.deque()).append((arrival, lot))
+
+    def best_lot(self, sell):
+        waiting = self.waiting.get(sell.asset)
+        discounted = self.discounted.setdefault(sell.asset, [])
+        while waiting and is_cgt_discounted(sell.date, waiting[0][1].date):
+            arrival, lot = waiting.popleft()
+            self.discounted_ids.add(lot.id)
+            self.push_lot(discounted, lot, arrival)
+
+        recent = self.heaps.get(sell.asset, [])
+        while recent and (recent[0][2].id in self.discounted_ids or self.remaining[recent[0][2].id] == 0):
+            heapq.heappop(recent)
+            self.lots_scanned += 1
+        recent_lot = recent[0][2] if recent else None
+        discounted_lot = self.top_lot(discounted)
+        if recent_lot is None or discounted_lot is None:
+            return recent_lot or discounted_lot
+
+        recent_gain = sell.price_aud - recent_lot.price_aud
+        discounted_gain = sell.price_aud - discounted_lot.price_aud
+        if discounted_gain > 0:
+            discounted_gain /= 2
+        return recent_lot if recent_gain < discounted_gain else discounted_lot
+
+
+STRATEGIES = collections.OrderedDict((strategy.name, strategy) for strategy in
+                                     [DefaultStrategy, FifoStrategy, LifoStrategy, HifoStrategy, MinTaxStrategy])
+
+
+def match_in_date_order(strategies, lots, sells):
+    """ Run several HeapStrategy side by side in one date ordered pass over lots and sells. A lot is added before
+    the sells dated after it. Returns a dict of strategy name -> list of (sell, lot, volume) claims """
+    lots = sorted(lots, key=lambda lot: lot.date)
+    claims = dict((strategy.name, list()) for strategy in strategies)
+    next_lot = 0
+    for sell in sorted(sells, key=lambda sell: sell.date):
+        while next_lot < len(lots) and lots[next_lot].date < sell.date:
+            for strategy in strategies:
+                strategy.add_lot(lots[next_lot])
+            next_lot += 1
+        for strategy in strategies:
+            claims[strategy.name].extend(strategy.match_sell(sell))
+    return claims
+
+
+def match_lots(strategy_name, lots, sells):
+    """ Return the (sell, lot, volume) claims the named strategy makes """
+    return STRATEGIES[strategy_name]().match(lots, sells)
+
+
+def match_asset(strategy_name, lots, sells):
+    """ Match the lots and sells of one asset, returning (sell id, lot id, volume) claims and the number of lots the
+    strategy scanned. Runs in pool workers, so it hands back ids rather than the tuples it was sent """
+    strategy = STRATEGIES[strategy_name]()
+    claims = [(sell.id, lot.id, volume) for sell, lot, volume in strategy.match(lots, sells)]
+    return claims, strategy.lots_scanned
+
+
+def match_lots_by_asset(strategy_name, lots, sells, workers=0, stats=None):
+    """ Split lots and sells by asset and match each asset on its own, across a pool of worker processes unless
+    workers is 0 or 1. A sell only ever claims lots of its own asset, so this makes the same claims as match_lots. Returns
+    the (sell id, lot id, volume) claims of each asset in turn, assets in name order. The lots scanned are added to
+    stats['lots_scanned'] when a stats Counter is given """
+    asset_lots = dict()
+    asset_sells = dict()
+    for lot in lots:
+        asset_lots.setdefault(lot.asset, []).append(lot)
+    for sell in sells:
+        asset_sells.setdefault(sell.asset, []).append(sell)
+    assets = sorted(asset_sells)
+    jobs = [(strategy_name, asset_lots.get(asset, []), asset_sells[asset]) for asset in assets]
+
+    if (workers or 0) <= 1 or len(jobs) < 2:
+        results = [match_asset(*job) for job in jobs]
+    else:
+        results = match_in_pool(jobs, workers)
+    if stats is not None:
+        stats['lots_scanned'] += sum(lots_scanned for claims, lots_scanned in results)
+    return [claim for claims, lots_scanned in results for claim in claims]
+
+
+def match_in_pool(jobs, workers):
+    """ Run match_asset over jobs across a pool of worker processes, returning the results in the order of jobs """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        # Biggest assets first, so one large asset does not start last and hold up the rest
+        futures = dict()
+        for job in sorted(jobs, key=lambda job: len(job[1]) + len(job[2]), reverse=True):
+            futures[job[2][0].asset] = executor.submit(match_asset, *job)
+        return [futures[job[2][0].asset].result() for job in jobs]
+
+
+def compare_strategies(strategy_names, lots, sells):
+    """ Match lots and sells under each named strategy, and return a dict of strategy name -> summarise_claims.
+    All the date ordered strategies share a single pass over the events """
+    strategies = [STRATEGIES[name]() for name in strategy_names]
+    in_date_order = [strategy for strategy in strategies if isinstance(strategy, HeapStrategy)]
+    claims = match_in_date_order(in_date_order, lots, sells)
+    for strategy in strategies:
+        if strategy.name not in claims:
+            claims[strategy.name] = strategy.match(lots, sells)
+    return collections.OrderedDict((name, summarise_claims(claims[name])) for name in strategy_names)
+
+
+def summarise_claims(claims):
+    """ Total up the capital gains from a list of claims. Capital losses are taken from the gains without the discount
+    first, and the CGT discount halves whatever discountable gain is left """
+    summary = collections.OrderedDict()
+    summary['claims'] = len(claims)
+    summary['proceeds_aud'] = Decimal(0)
+    summary['cost_base_aud'] = Decimal(0)
+    summary['undiscounted_gain'] = Decimal(0)
+    summary['discountable_gain'] = Decimal(0)
+    for sell, lot, volume in claims:
+        proceeds = sell.price_aud * volume
+        cost_base = lot.price_aud * volume
+        summary['proceeds_aud'] += proceeds
+        summary['cost_base_aud'] += cost_base
+        if is_cgt_discounted(sell.date, lot.date) and proceeds > cost_base:
+            summary['discountable_gain'] += proceeds - cost_base
+        else:
+            summary['undiscounted_gain'] += proceeds - cost_base
+
+    discountable_gain = summary['discountable_gain']
+    if summary['undiscounted_gain'] < 0:
+        discountable_gain = max(discountable_gain + summary['undiscounted_gain'], Decimal(0))
+    summary['net_capital_gain'] = max(summary['undiscounted_gain'], Decimal(0)) + discountable_gain / 2
+    return summary
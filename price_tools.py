@@ -1,78 +1,446 @@
+import io
 import os
 import csv
+import mmap
+import bisect
+import struct
+import hashlib
+import tempfile
+import logging
 import datetime
+import functools
+import collections
+from array import array
 from decimal import Decimal
 
 
 
 PRICE_DATA_DIR = "bars/"
-PRICE_DATA = dict()  # keys are asset pair strings base_quote
+PRICE_INTRADAY_DIR = "bars_intraday/"  # hourly or minute bars, used for trades which have a time of day
+PRICE_CACHE_DIR = "bars_cache/"  # binary copies of the bars, None to always parse the csv files
+PRICE_CACHE_MAGIC = b"JTPC"
+PRICE_CACHE_VERSION = 2
+PRICE_CACHE_HEADER = struct.Struct("=4sIqqQ20sq")  # magic, version, csv mtime_ns, csv size, day count, csv sha1,
+                                                    # first day ordinal
+PRICE_CACHE_HEADER_SIZE = 64  # header padded so the mids that follow are 8 byte aligned
+PRICE_DATA = dict()  # keys are asset pair strings base_quote, values are PriceSeries, filled in on first use
+INTRADAY_DATA = dict()  # keys are asset pair strings, values are IntradaySeries or None for pairs without the bars
+PRICE_QUOTE_ASSET = "AUD"  # every asset is valued in this
+PRICE_MAX_STALE_DAYS = 3  # a pair without a bar on the day uses the latest bar up to this many days before
+PRICE_INTRADAY_MAX_STALE_SECONDS = 2 * 3600  # a fill this long after the start of the latest bar uses the daily bar
+PRICE_RATE_CACHE_SIZE = 1 << 16  # resolved (asset, day) rates to remember
+SECONDS_PER_DAY = 24 * 3600
+UNIX_EPOCH_SECONDS = datetime.date(1970, 1, 1).toordinal() * SECONDS_PER_DAY
+
+
+class PriceLookupError(KeyError):
+    """ Raised when a pair has no usable price on a date """
+    def __str__(self):
+        return self.args[0]
+
+
+class PriceSeries:
+    """ The daily bars of one asset pair as a dense calendar of (high + low) / 2 mid prices, from the first bar to the
+    last. Days without a bar are forward filled from the bar before them, and ages counts how stale each day is """
+    def __init__(self, asset_pair, first_ordinal, mids, ages):
+        self.asset_pair = asset_pair
+        self.first_ordinal = first_ordinal  # datetime.date ordinal of mids[0]
+        self.mids = mids  # array of mid prices, mids[i] is the price on first_ordinal + i
+        self.ages = ages  # array of days since the bar mids[i] was filled from, 0 on days with a bar
+
+    def __len__(self):
+        return len(self.mids)
+
+    def mid_at(self, ordinal, max_stale_days=None):
+        """ Return the mid price on the day with this ordinal. Days after the last bar are filled from it too, and
+        filled prices more than max_stale_days old are refused """
+        position = ordinal - self.first_ordinal
+        if position < 0 or not self.mids:
+            raise PriceLookupError("%s has no bars on or before %s" % (self.asset_pair, format_ordinal(ordinal)))
+
+        if position < len(self.mids):
+            mid, age = self.mids[position], self.ages[position]
+        else:
+            mid, age = self.mids[-1], self.ages[-1] + position - len(self.mids) + 1
+
+        if max_stale_days is not None and age > max_stale_days:
+            raise PriceLookupError("%s has no bar on %s, the latest before it is %s days old (limit %s)" % (
+                self.asset_pair, format_ordinal(ordinal), age, max_stale_days))
+        return mid
+
+
+class IntradaySeries:
+    """ The hourly or minute bars of one asset pair, as sorted arrays of bar start times, in seconds from the start of
+    day ordinal 0, and their (high + low) / 2 mid prices. Nothing is filled in, a fill is found by bisection """
+    def __init__(self, asset_pair, times, mids):
+        self.asset_pair = asset_pair
+        self.times = times  # array of bar start times, ascending
+        self.mids = mids  # array of mid prices, mids[i] is the price from times[i] until the next bar
+
+    def __len__(self):
+        return len(self.times)
+
+    def mid_at(self, seconds, max_stale_seconds=None):
+        """ Return the mid price of the bar containing seconds, the latest bar which starts at or before it, or None
+        when there is no such bar or it starts more than max_stale_seconds before """
+        position = bisect.bisect_right(self.times, seconds) - 1
+        if position < 0:
+            return None
+        if max_stale_seconds is not None and seconds - self.times[position] > max_stale_seconds:
+            return None
+        return self.mids[position]
+
+
+def datetime_to_seconds(date_time):
+    """ Return the seconds from the start of day ordinal 0 to date_time, the time scale of IntradaySeries """
+    return (date_time.toordinal() * SECONDS_PER_DAY + date_time.hour * 3600 + date_time.minute * 60 +
+            date_time.second)
+
+
+def has_time_of_day(date_time):
+    """ Dates read without a time are midnight, and are priced from daily bars """
+    return isinstance(date_time, datetime.datetime) and date_time.time() != datetime.time()
+
+
+def format_ordinal(ordinal):
+    return datetime.date.fromordinal(ordinal).strftime("%Y-%m-%d")
 
 
 def read_folder(folder_path):
     for file in os.listdir(folder_path):
         if file.endswith(".csv"):
             pair_string = os.path.splitext(file)[0]
-            index_price_data(os.path.join(PRICE_DATA_DIR, file), pair_string)
+            index_price_data(os.path.join(folder_path, file), pair_string)
+
+
+def preload(asset_pairs=None):
+    """ Load price data up front, rather than on first use, with any intraday bars for the same pairs. Loads every
+    pair in PRICE_DATA_DIR by default """
+    if asset_pairs is None:
+        read_folder(PRICE_DATA_DIR)
+        asset_pairs = list(PRICE_DATA)
+
+    for asset_pair in asset_pairs:
+        get_pair_data(asset_pair)
+        get_intraday_data(asset_pair)
+
+
+def clear_price_data():
+    """ Forget all loaded pairs, routes and resolved rates, so bars are read again on next use """
+    PRICE_DATA.clear()
+    INTRADAY_DATA.clear()
+    get_conversion_graph.cache_clear()
+    get_conversion_path.cache_clear()
+    get_price_at_ordinal.cache_clear()
+    get_price_at_seconds.cache_clear()
+
+
+def get_pair_data(asset_pair):
+    """ Return the bars for asset_pair, reading them from PRICE_DATA_DIR the first time they are asked for """
+    price_data = PRICE_DATA.get(asset_pair)
+    if price_data is None:
+        filename = os.path.join(PRICE_DATA_DIR, asset_pair + ".csv")
+        if not os.path.exists(filename):
+            raise KeyError(asset_pair)
+        index_price_data(filename, asset_pair)
+        price_data = PRICE_DATA[asset_pair]
+    return price_data
+
+
+def get_intraday_data(asset_pair):
+    """ Return the intraday bars for asset_pair from PRICE_INTRADAY_DIR, reading them the first time they are asked
+    for, or None when the pair has none """
+    if asset_pair not in INTRADAY_DATA:
+        filename = os.path.join(PRICE_INTRADAY_DIR, asset_pair + ".csv")
+        if not os.path.exists(filename):
+            INTRADAY_DATA[asset_pair] = None
+        elif PRICE_CACHE_DIR is None:
+            with open(filename, 'rb') as csvfile:
+                first_ordinal, times, mids = parse_intraday_csv(csvfile.read())
+            INTRADAY_DATA[asset_pair] = IntradaySeries(asset_pair, times, mids)
+        else:
+            INTRADAY_DATA[asset_pair] = load_price_cache(filename, asset_pair, "intraday", parse_intraday_csv,
+                                                         open_intraday_cache)
+        if INTRADAY_DATA[asset_pair] is not None:
+            logging.debug("loaded %s intraday bars for %s" % (len(INTRADAY_DATA[asset_pair]), asset_pair))
+    return INTRADAY_DATA[asset_pair]
 
 
 def index_price_data(filename, asset_pair):
-    """ Read price data into memory """
+    """ Read price data into memory, through the binary cache when there is one """
     global PRICE_DATA
-    with open(filename, newline='') as csvfile:
-        fieldnames = ['date', 'open', 'high', 'low', 'close', 'volume']
-        file_reader = csv.DictReader(csvfile, delimiter=',', fieldnames=fieldnames)
-        price_data = dict()
-        for row in file_reader:
+    if PRICE_CACHE_DIR is None:
+        with open(filename, 'rb') as csvfile:
+            first_ordinal, mids, ages = parse_price_csv(csvfile.read())
+        PRICE_DATA[asset_pair] = PriceSeries(asset_pair, first_ordinal, mids, ages)
+    else:
+        PRICE_DATA[asset_pair] = load_price_cache(filename, asset_pair)
+    logging.debug("loaded %s bars for %s" % (len(PRICE_DATA[asset_pair]), asset_pair))
+
+
+def parse_price_csv(csv_bytes):
+    """ Parse bar csv data into the first day ordinal and dense, forward filled arrays of mid prices and their ages """
+    file_reader = csv.reader(io.StringIO(csv_bytes.decode()), delimiter=',')
+    bars = list()
+    for row in file_reader:
+        try:
+            date_ordinal = datetime.date(*map(int, row[0].split("-"))).toordinal()
+            bars.append((date_ordinal, (float(row[2]) + float(row[3])) / 2))
+        except Exception as e:
+            print("Failed to interpret line: %s" % e)
+            print("--", row)
+            raise
+    bars.sort()
+    mids = array('d')
+    ages = array('i')
+    if not bars:
+        return 0, mids, ages
+
+    first_ordinal = bars[0][0]
+    for date_ordinal, mid in bars:
+        position = date_ordinal - first_ordinal
+        if position < len(mids):
+            # a repeated date, the later row wins
+            mids[position] = mid
+            continue
+        for _ in range(position - len(mids)):
+            mids.append(mids[-1])
+            ages.append(ages[-1] + 1)
+        mids.append(mid)
+        ages.append(0)
+    return first_ordinal, mids, ages
+
+
+def parse_bar_time(text):
+    """ Return the seconds from the start of day ordinal 0 of an intraday bar time, either unix seconds or an ISO
+    date and time such as 2017-08-12 14:00:00, both UTC """
+    if text.isdigit():
+        return UNIX_EPOCH_SECONDS + int(text)
+    return datetime_to_seconds(datetime.datetime.fromisoformat(text))
+
+
+def parse_intraday_csv(csv_bytes):
+    """ Parse intraday bar csv data, laid out like the daily bars with a bar time in place of the date, into sorted
+    arrays of bar times and mid prices. Rows are read straight into the arrays, and only sorted if they were not in
+    order already. The first return value is unused, it keeps the shape of parse_price_csv for load_price_cache """
+    times = array('q')
+    mids = array('d')
+    in_order = True
+    for row in csv.reader(io.StringIO(csv_bytes.decode()), delimiter=','):
+        try:
+            seconds = parse_bar_time(row[0])
+            if times and seconds <= times[-1]:
+                in_order = False
+            times.append(seconds)
+            mids.append((float(row[2]) + float(row[3])) / 2)
+        except Exception as e:
+            print("Failed to interpret line: %s" % e)
+            print("--", row)
+            raise
+    if not in_order:
+        # Stable, so of repeated times the later row wins like it does for daily bars
+        order = sorted(range(len(times)), key=times.__getitem__)
+        kept = [position for index, position in enumerate(order)
+                if index + 1 == len(order) or times[order[index + 1]] != times[position]]
+        times = array('q', [times[position] for position in kept])
+        mids = array('d', [mids[position] for position in kept])
+    return 0, times, mids
+
+
+def load_price_cache(filename, asset_pair, kind="daily", parse=parse_price_csv, open_cache=None):
+    """ Return a PriceSeries backed by a read only mmap of the cached bars for asset_pair. The cache is rebuilt from
+    filename when its recorded mtime and size no longer match and the csv contents hash differently. Intraday bars
+    pass their own kind, parse and open_cache functions, parse returning the first day ordinal and the arrays to
+    store, all of the same length """
+    if open_cache is None:
+        open_cache = open_price_cache
+    cache_filename = os.path.join(PRICE_CACHE_DIR, asset_pair + ".bin")
+    if kind != "daily":
+        cache_filename = os.path.join(PRICE_CACHE_DIR, "%s.%s.bin" % (asset_pair, kind))
+    csv_stat = os.stat(filename)
+    header = read_price_cache_header(cache_filename)
+    if header is None or (header[2], header[3]) != (csv_stat.st_mtime_ns, csv_stat.st_size):
+        with open(filename, 'rb') as csvfile:
+            csv_bytes = csvfile.read()
+        csv_hash = hashlib.sha1(csv_bytes).digest()
+        if header is not None and header[5] == csv_hash:
+            # Touched but not changed, keep the bars and record the new mtime. If that can't be written the bars
+            # are still right, so the cache is used as it is and the csv hashed again next time
+            try:
+                with open(cache_filename, 'rb') as cachefile:
+                    body = cachefile.read()[PRICE_CACHE_HEADER_SIZE:]
+                write_price_cache(cache_filename, csv_stat, header[4], csv_hash, header[6], body)
+            except OSError as e:
+                logging.warning("Unable to write price cache %s: %s" % (cache_filename, e))
+        else:
+            first_ordinal, *arrays = parse(csv_bytes)
             try:
-                date_string = row['date']
-                price_data[date_string] = row
-            except Exception as e:
-                print("Failed to interpret line: %s" % e)
-                print("--", row)
-                raise
-        PRICE_DATA[asset_pair] = price_data
-        print("loaded %s bars for %s" % (len(price_data), asset_pair))
+                write_price_cache(cache_filename, csv_stat, len(arrays[0]), csv_hash, first_ordinal,
+                                  b"".join(column.tobytes() for column in arrays))
+            except OSError as e:
+                logging.warning("Unable to write price cache %s: %s" % (cache_filename, e))
+                if kind != "daily":
+                    return IntradaySeries(asset_pair, *arrays)
+                return PriceSeries(asset_pair, first_ordinal, *arrays)
+    return open_cache(cache_filename, asset_pair)
+
+
+def read_price_cache_header(cache_filename):
+    """ Return the unpacked header of a cache file, or None if it is missing or not a cache we understand """
+    try:
+        with open(cache_filename, 'rb') as cachefile:
+            header = PRICE_CACHE_HEADER.unpack(cachefile.read(PRICE_CACHE_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if header[0] != PRICE_CACHE_MAGIC or header[1] != PRICE_CACHE_VERSION:
+        return None
+    return header
+
+
+def write_price_cache(cache_filename, csv_stat, day_count, csv_hash, first_ordinal, body):
+    """ Write a cache file, replacing any old one atomically so processes which have it mapped are unaffected """
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    header = PRICE_CACHE_HEADER.pack(PRICE_CACHE_MAGIC, PRICE_CACHE_VERSION, csv_stat.st_mtime_ns, csv_stat.st_size,
+                                     day_count, csv_hash, first_ordinal)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_filename), delete=False) as cachefile:
+        cachefile.write(header.ljust(PRICE_CACHE_HEADER_SIZE, b"\0"))
+        cachefile.write(body)
+    os.replace(cachefile.name, cache_filename)
+
+
+def open_price_cache(cache_filename, asset_pair):
+    """ Map a cache file and view its mids and ages in place, without copying them onto the heap """
+    with open(cache_filename, 'rb') as cachefile:
+        cache_map = mmap.mmap(cachefile.fileno(), 0, access=mmap.ACCESS_READ)
+    header = PRICE_CACHE_HEADER.unpack_from(cache_map)
+    day_count, first_ordinal = header[4], header[6]
+    mids_end = PRICE_CACHE_HEADER_SIZE + 8 * day_count
+    cache_view = memoryview(cache_map)
+    mids = cache_view[PRICE_CACHE_HEADER_SIZE:mids_end].cast('d')
+    ages = cache_view[mids_end:mids_end + 4 * day_count].cast('i')
+    return PriceSeries(asset_pair, first_ordinal, mids, ages)
+
+
+def open_intraday_cache(cache_filename, asset_pair):
+    """ Map an intraday cache file and view its times and mids in place. Bisection reads only the pages it visits,
+    so a pair with millions of bars costs little more memory than one with a few """
+    with open(cache_filename, 'rb') as cachefile:
+        cache_map = mmap.mmap(cachefile.fileno(), 0, access=mmap.ACCESS_READ)
+    bar_count = PRICE_CACHE_HEADER.unpack_from(cache_map)[4]
+    times_end = PRICE_CACHE_HEADER_SIZE + 8 * bar_count
+    cache_view = memoryview(cache_map)
+    times = cache_view[PRICE_CACHE_HEADER_SIZE:times_end].cast('q')
+    mids = cache_view[times_end:times_end + 8 * bar_count].cast('d')
+    return IntradaySeries(asset_pair, times, mids)
 
 
 def get_price_at_datetime(asset_name, date_time):
-    """ Return the value of asset_name at date_time in AUD. convert from asset_name to BTC, and then from BTC to AUD """
-    global PRICE_DATA
+    """ Return the value of asset_name at date_time in AUD, converting along its conversion path. A date_time with a
+    time of day is priced from the intraday bar containing it where there is one """
+    if has_time_of_day(date_time):
+        return get_price_at_seconds(asset_name, datetime_to_seconds(date_time))
+    return get_price_at_ordinal(asset_name, date_time.toordinal())
+
+
+def get_prices(asset_name, dates):
+    """ Return a list with the value of asset_name on each of dates, as get_price_at_datetime would. Each distinct
+    day, or time for dates with a time of day, is only priced once, so valuing a whole trade history in one call
+    does not repeat the lookups """
+    keys = [date_time if has_time_of_day(date_time) else date_time.toordinal() for date_time in dates]
+    prices = dict()
+    for key, date_time in zip(keys, dates):
+        if key not in prices:
+            prices[key] = get_price_at_datetime(asset_name, date_time)
+    return [prices[key] for key in keys]
+
+
+@functools.lru_cache(maxsize=None)
+def get_conversion_graph():
+    """ Return the currency graph formed by the pair files in PRICE_DATA_DIR. Keys are assets, values are a sorted
+    list of (neighbour asset, pair, inverted) edges. A BASE_QUOTE pair converts base to quote at its price, and quote
+    to base (inverted) at one over its price """
+    graph = dict()
+    for file in sorted(os.listdir(PRICE_DATA_DIR)):
+        if file.endswith(".csv"):
+            asset_pair = os.path.splitext(file)[0]
+            base, _, quote = asset_pair.partition("_")
+            graph.setdefault(base, []).append((quote, asset_pair, False))
+            graph.setdefault(quote, []).append((base, asset_pair, True))
+    for edges in graph.values():
+        edges.sort()
+    return graph
+
+
+@functools.lru_cache(maxsize=None)
+def get_conversion_path(asset_name):
+    """ Return the shortest list of (pair, inverted) legs which converts asset_name to PRICE_QUOTE_ASSET """
+    graph = get_conversion_graph()
+    came_from = {asset_name: None}
+    queue = collections.deque([asset_name])
+    while queue:
+        asset = queue.popleft()
+        if asset == PRICE_QUOTE_ASSET:
+            path = list()
+            while came_from[asset] is not None:
+                asset, asset_pair, inverted = came_from[asset]
+                path.append((asset_pair, inverted))
+            return path[::-1]
 
+        for neighbour, asset_pair, inverted in graph.get(asset, []):
+            if neighbour not in came_from:
+                came_from[neighbour] = (asset, asset_pair, inverted)
+                queue.append(neighbour)
+    raise PriceLookupError("no price route from %s to %s" % (asset_name, PRICE_QUOTE_ASSET))
+
+
+def get_pair_rate(asset_pair, ordinal):
+    """ Return the mid price of asset_pair on the day with this ordinal. Weekends and holidays read the latest bar
+    before them, as long as it is no more than PRICE_MAX_STALE_DAYS old """
+    return get_pair_data(asset_pair).mid_at(ordinal, PRICE_MAX_STALE_DAYS)
+
+
+@functools.lru_cache(maxsize=PRICE_RATE_CACHE_SIZE)
+def get_price_at_ordinal(asset_name, ordinal):
+    """ Return the value of asset_name on the day with this date ordinal, following its conversion path one pair at a
+    time. Resolved rates are remembered, up to PRICE_RATE_CACHE_SIZE of the most recently used """
     """ None is zero..? """
     if asset_name in ['None', 'NONE']:
         return Decimal(0.0)
 
-    """ If asset_name is AUD, we know it is 1.0 """
-    if asset_name in ['AUD']:
+    """ If asset_name is the quote asset, we know it is 1.0 """
+    if asset_name == PRICE_QUOTE_ASSET:
         return Decimal(1.0)
 
-    if asset_name in ['BTC']:
-        """ look up btc_usdt at this date """
-        rate = PRICE_DATA['BTC_USDT'][date_time.strftime("%Y-%m-%d")]
-        #print("VALS:", float(rate['high']), float(rate['low']), (float(rate['high']) + float(rate['low'])) / 2)
-        return Decimal((float(rate['high']) + float(rate['low'])) / 2)
-
-    if asset_name in ['USDT']:
-        """ look up usdt_aud at this date """
-        if date_time.strftime("%Y-%m-%d") in PRICE_DATA['USDT_AUD']:
-            rate = PRICE_DATA['USDT_AUD'][date_time.strftime("%Y-%m-%d")]
-        elif (date_time - datetime.timedelta(days=1)).strftime("%Y-%m-%d") in PRICE_DATA['USDT_AUD']:
-            rate = PRICE_DATA['USDT_AUD'][(date_time - datetime.timedelta(days=1)).strftime("%Y-%m-%d")]
-        elif (date_time - datetime.timedelta(days=2)).strftime("%Y-%m-%d") in PRICE_DATA['USDT_AUD']:
-            rate = PRICE_DATA['USDT_AUD'][(date_time - datetime.timedelta(days=2)).strftime("%Y-%m-%d")]
-        else:
-            print("something fucked up?", date_time.strftime("%Y-%m-%d"))
+    price = None
+    for asset_pair, inverted in get_conversion_path(asset_name):
+        rate = Decimal(get_pair_rate(asset_pair, ordinal))
+        if inverted:
+            rate = 1 / rate
+        price = rate if price is None else price * rate
+    return price
 
-        #print("VALS:", float(rate['high']), float(rate['low']), (float(rate['high']) + float(rate['low'])) / 2)
-        return Decimal((float(rate['high']) + float(rate['low'])) / 2)
 
-    """ Get this pair with BTC ratio """
-    pair_step = asset_name + "_BTC"
-    rate = PRICE_DATA[pair_step][date_time.strftime("%Y-%m-%d")]
-    other_rate = get_price_at_datetime('BTC', date_time)
-    #print("VALS2:", float(rate['high']), float(rate['low']), (float(rate['high']) + float(rate['low'])) / 2)
-    return other_rate * Decimal((float(rate['high']) + float(rate['low'])) / 2)
+@functools.lru_cache(maxsize=PRICE_RATE_CACHE_SIZE)
+def get_price_at_seconds(asset_name, seconds):
+    """ Return the value of asset_name at a time, in seconds from the start of day ordinal 0, like
+    get_price_at_ordinal. Each pair on the conversion path is priced from its intraday bar containing the time, and
+    pairs without intraday bars there fall back to their daily bar """
+    if asset_name in ['None', 'NONE']:
+        return Decimal(0.0)
 
+    if asset_name == PRICE_QUOTE_ASSET:
+        return Decimal(1.0)
 
-read_folder(PRICE_DATA_DIR)
+    price = None
+    for asset_pair, inverted in get_conversion_path(asset_name):
+        intraday = get_intraday_data(asset_pair)
+        mid = None
+        if intraday is not None:
+            mid = intraday.mid_at(seconds, PRICE_INTRADAY_MAX_STALE_SECONDS)
+        if mid is None:
+            mid = get_pair_rate(asset_pair, seconds // SECONDS_PER_DAY)
+        rate = Decimal(mid)
+        if inverted:
+            rate = 1 / rate
+        price = rate if price is None else price * rate
+    return price
@@ -1,114 +1,406 @@
+import io
 import csv
 import sys
+import json
+import sqlite3
+import itertools
 import os
+import time
 import logging
+import argparse
 import datetime
+import functools
+import collections
+import concurrent.futures
+from array import array
 import price_tools
+import lot_matching
 from decimal import Decimal
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 FILENAME = "sample_trade.csv"
-INPUT_COUNTER = 0
-SELL_EVENT_COUNTER = 0
-BUY_EVENT_COUNTER = 0
-ALL_INPUT_RECORDS = list()  # A list of all transaction records
-ALL_BUY_EVENTS = list()  # A list of all buy events
-ALL_SELL_EVENTS = list()  # A list of all sell events
+SNAPSHOT_VERSION = 1
+INPUT_DATE_FORMATS = ["%d/%m/%Y", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M"]  # a time of day is priced intraday
+INPUT_CHUNK_BYTES = 4 << 20  # Input files are parsed in chunks of about this many bytes
+INPUT_PARALLEL_MIN_BYTES = 16 << 20  # Less input than this is parsed in process, a pool would cost more than it saves
+LINK_TUPLE_MAX = 8  # Event links are kept in a tuple up to this many, then an array
+PROFILE_VERSION = 2
+OUTPUT_FORMATS = ['csv', 'sqlite']
+OUTPUT_DATABASE = "output.sqlite"
+OUTPUT_DATABASE_BATCH_ROWS = 50000  # Rows are inserted into the output database this many to a transaction
+PROFILE_COUNTERS = ['input_records', 'records_priced', 'price_lookups', 'sells_matched', 'sells_unclaimed',
+                    'lots_scanned', 'taxable_event_linked']  # reported even when 0
+
+OUTPUT_DATABASE_SCHEMA = """
+CREATE TABLE input_records (id INTEGER PRIMARY KEY, date TEXT, buy_asset TEXT, buy_volume TEXT, sell_asset TEXT,
+    sell_volume TEXT, fee_asset TEXT, fee_volume TEXT, unclaimed_buy_volume TEXT, unclaimed_sell_volume TEXT,
+    comment TEXT);
+CREATE TABLE buy_events (id INTEGER PRIMARY KEY, date TEXT, input_record INTEGER, buy_unclaimed_volume TEXT,
+    buy_asset TEXT, buy_volume TEXT, buy_price_aud TEXT, buy_volume_aud TEXT, comment TEXT);
+CREATE TABLE sell_events (id INTEGER PRIMARY KEY, date TEXT, input_record INTEGER, cost_base_aud TEXT,
+    sell_unclaimed_volume TEXT, sell_asset TEXT, sell_volume TEXT, sell_price_aud TEXT, sell_volume_aud TEXT,
+    gross_profit TEXT, net_profit TEXT, fee_aud TEXT, days_held INTEGER, cgt_discount INTEGER, comment TEXT);
+CREATE TABLE sell_buy_links (sell_event INTEGER, buy_event INTEGER, position INTEGER);
+"""
+OUTPUT_DATABASE_INDEXES = """
+CREATE INDEX input_records_date ON input_records (date);
+CREATE INDEX input_records_buy_asset ON input_records (buy_asset);
+CREATE INDEX input_records_sell_asset ON input_records (sell_asset);
+CREATE INDEX buy_events_asset_date ON buy_events (buy_asset, date);
+CREATE INDEX buy_events_input_record ON buy_events (input_record);
+CREATE INDEX sell_events_asset_date ON sell_events (sell_asset, date);
+CREATE INDEX sell_events_input_record ON sell_events (input_record);
+CREATE INDEX sell_buy_links_sell_event ON sell_buy_links (sell_event);
+CREATE INDEX sell_buy_links_buy_event ON sell_buy_links (buy_event);
+"""
+
+
+class TaxRun:
+    """ The state of one portfolio's calculation, so several portfolios can be worked out in one process. The price
+    data lives in price_tools and is shared by every run """
+    def __init__(self, input_dir="input/", output_dir="."):
+        self.input_dir = input_dir  # Directory of input trade csv files
+        self.output_dir = output_dir  # Directory the output files are written to
+        self.input_counter = 0
+        self.sell_event_counter = 0
+        self.buy_event_counter = 0
+        self.input_records = list()  # A list of all transaction records
+        self.buy_events = list()  # A list of all buy events
+        self.sell_events = list()  # A list of all sell events
+        self.snapshot_date = None  # The as_of date of the snapshot this run carries on from, if any
+        self.phase_seconds = collections.OrderedDict()  # phase name -> wall seconds spent in it, see timed_phase
+        self.stats = collections.Counter()  # hot path counters, see profile_report
+
+    def next_input_id(self):
+        self.input_counter += 1
+        return self.input_counter - 1
+
+    def next_sell_event_id(self):
+        self.sell_event_counter += 1
+        return self.sell_event_counter - 1
+
+    def next_buy_event_id(self):
+        self.buy_event_counter += 1
+        return self.buy_event_counter - 1
+
+    def output_path(self, file_name):
+        return os.path.join(self.output_dir, file_name)
+
+
+def cache_counts():
+    """ Return the hits and misses of the lru caches on the hot paths, by name """
+    caches = [('input_date_cache', parse_input_date),
+              ('conversion_path_cache', price_tools.get_conversion_path),
+              ('price_cache', price_tools.get_price_at_ordinal),
+              ('intraday_price_cache', price_tools.get_price_at_seconds)]
+    counts = dict()
+    for name, function in caches:
+        info = function.cache_info()
+        counts[name + '_hits'] = info.hits
+        counts[name + '_misses'] = info.misses
+    return counts
+
+
+def timed_phase(run, phase, function, *args, **kwargs):
+    """ Call function, adding the wall time it takes to run.phase_seconds[phase], and the cache hits and misses
+    made meanwhile to run.stats. Lookups made in pool workers are not seen """
+    caches_before = cache_counts()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    run.phase_seconds[phase] = run.phase_seconds.get(phase, 0) + time.perf_counter() - start
+    for name, count in cache_counts().items():
+        run.stats[name] += count - caches_before[name]
+    return result
+
+
+def profile_report(run):
+    """ Return the phase timings and counters of run as a dict ready for json """
+    report = collections.OrderedDict()
+    report['version'] = PROFILE_VERSION
+    report['input_dir'] = run.input_dir
+    report['phase_seconds'] = run.phase_seconds
+    report['total_seconds'] = sum(run.phase_seconds.values())
+    counters = dict((name, 0) for name in PROFILE_COUNTERS)
+    counters.update(run.stats)
+    report['counters'] = collections.OrderedDict(sorted(counters.items()))
+    sells = run.stats['sells_matched']
+    report['lots_scanned_per_sell'] = run.stats['lots_scanned'] / sells if sells else None
+    return report
+
+
+def write_profile(run, file_name):
+    with open(file_name, 'w') as profile_file:
+        json.dump(profile_report(run), profile_file, indent=1)
 
 
 class InputRecord:
-    def __init__(self, date, buy_asset, buy_volume, sell_asset, sell_volume, fee_asset, fee_volume, sell_events=None, buy_events=None, comment=""):
-        global INPUT_COUNTER
-        self.id = INPUT_COUNTER
-        INPUT_COUNTER += 1
-        if sell_events is None:
-            sell_events = list()
-
-        if buy_events is None:
-            buy_events = list()
-
-        self.date = datetime.datetime.strptime(date, "%d/%m/%Y")  # When the event occurred
-        self.buy_events = buy_events
-        self.buy_asset = buy_asset.upper()  # The asset which we bought
+    __slots__ = ['id', 'date', 'buy_events', 'buy_asset', 'buy_volume', 'sell_events', 'sell_asset', 'sell_volume',
+                 'fee_asset', 'fee_volume', 'comment', 'unclaimed_buy_volume', 'unclaimed_sell_volume',
+                 'unclaimed_fee_volume']
+
+    def __init__(self, date, buy_asset, buy_volume, sell_asset, sell_volume, fee_asset, fee_volume, sell_events=None, buy_events=None, comment="", id=None):
+        self.id = id  # Unique ID for this record, handed out by its TaxRun
+        self.date = date if isinstance(date, datetime.datetime) else parse_input_date(date)  # When the event occurred
+        self.buy_events = tuple(buy_events or ())  # ids of the BuyEvent which claimed this record's buy, see add_link
+        self.buy_asset = sys.intern(buy_asset.upper())  # The asset which we bought
         self.buy_volume = Decimal(buy_volume)  # The volume of bought asset
-        self.sell_events = sell_events
-        self.sell_asset = sell_asset.upper()  # The asset which we sold
+        self.sell_events = tuple(sell_events or ())  # ids of the SellEvent which claimed this record's sell
+        self.sell_asset = sys.intern(sell_asset.upper())  # The asset which we sold
         self.sell_volume = Decimal(sell_volume)  # The volume of sold asset
-        self.fee_asset = fee_asset.upper()  # The asset which fee was charged
+        self.fee_asset = sys.intern(fee_asset.upper())  # The asset which fee was charged
         self.fee_volume = Decimal(fee_volume)  # The volume of fee charged
         self.comment = comment  # A comment...
-        self.unclaimed_buy_volume = Decimal(buy_volume)  # The volume of 'buy_asset' which has not been claimed
-        self.unclaimed_sell_volume = Decimal(sell_volume)  # The volume of 'sell_asset' which has not been claimed
-        self.unclaimed_fee_volume = Decimal(fee_volume)  # The volume of 'fees' which has not been claimed
-        self.tax_events = []  # A list of TaxEvent objects
+        # Decimals are immutable, so the unclaimed volumes start out sharing the volumes rather than copying them
+        self.unclaimed_buy_volume = self.buy_volume  # The volume of 'buy_asset' which has not been claimed
+        self.unclaimed_sell_volume = self.sell_volume  # The volume of 'sell_asset' which has not been claimed
+        self.unclaimed_fee_volume = self.fee_volume  # The volume of 'fees' which has not been claimed
+
+
+def add_link(links, event_id):
+    """ Return links with event_id added. Most events link to no other event or to one, so links start out as the
+    shared empty tuple and stay a tuple while they are short, and only a long run of links becomes an id array """
+    if type(links) is tuple:
+        if len(links) < LINK_TUPLE_MAX:
+            return links + (event_id,)
+        links = array('q', links)
+    links.append(event_id)
+    return links
 
 
 class SellEvent:
-    def __init__(self, date, input_record, buy_events, cost_base_aud, sell_asset, sell_volume, sell_price_aud, sell_volume_aud, gross_profit, net_profit, fee_aud, sell_unclaimed_volume=0.0, days_held=0, comment=""):
-        global SELL_EVENT_COUNTER
-        self.id = SELL_EVENT_COUNTER  # Unique ID for this entry
-        SELL_EVENT_COUNTER += 1
+    """ The amounts in AUD which follow from the price, volumes and matched cost base are worked out when they are
+    read, rather than each being held as another Decimal """
+    __slots__ = ['id', 'date', 'input_record', 'buy_events', 'cost_base_aud', 'sell_unclaimed_volume', 'sell_asset',
+                 'sell_volume', 'sell_price_aud', 'fee_price_aud', 'days_held', 'comment']
+
+    def __init__(self, date, input_record, buy_events, cost_base_aud, sell_asset, sell_volume, sell_price_aud, fee_price_aud, sell_unclaimed_volume=0.0, days_held=0, comment="", id=None):
+        self.id = id  # Unique ID for this entry
         self.date = date  # Date when this sell event occured
-        self.input_record = input_record
-        self.buy_events = buy_events  # link to a BuyEvent object where the asset was bought
+        self.input_record = input_record  # The InputRecord this was made from, which outlives it anyway
+        self.buy_events = tuple(buy_events)  # ids of the BuyEvent where the asset was bought, see add_link
         self.cost_base_aud = cost_base_aud  # The cost base for this event
         self.sell_unclaimed_volume = sell_unclaimed_volume  # Volume of asset which has not been linked to buy event
         self.sell_asset = sell_asset  # Asset which was sold
         self.sell_volume = sell_volume  # Volume of the asset which was sold
         self.sell_price_aud = sell_price_aud  # Price ($aud per unit) the asset was sold
-        self.sell_volume_aud = sell_volume_aud  # The total $aud volume which was sold
-        self.gross_profit = gross_profit  # Sale of asset minus Cost of asset
-        self.net_profit = net_profit  # gross profit minus fees
-        self.fee_aud = fee_aud  # The $aud paid in fees
+        self.fee_price_aud = fee_price_aud  # Price ($aud per unit) of the asset the fee was paid in
         self.days_held = days_held
         self.comment = comment
 
-    def calculate_profit(self):
-        self.gross_profit = self.sell_volume_aud - self.cost_base_aud
-        self.net_profit = self.gross_profit - self.fee_aud
+    @property
+    def sell_volume_aud(self):
+        # The total $aud volume which was sold
+        return self.sell_price_aud * self.sell_volume
+
+    @property
+    def fee_aud(self):
+        # The $aud paid in fees
+        return self.fee_price_aud * self.input_record.unclaimed_fee_volume
+
+    @property
+    def gross_profit(self):
+        # Sale of asset minus Cost of asset, 0 until the sell has been matched with a buy
+        if not self.buy_events:
+            return 0
+        return self.sell_volume_aud - self.cost_base_aud
+
+    @property
+    def net_profit(self):
+        # gross profit minus fees
+        if not self.buy_events:
+            return 0
+        return self.gross_profit - self.fee_aud
 
 
 class BuyEvent:
-    def __init__(self, date, input_record, sell_events, buy_asset, buy_volume, buy_price_aud, buy_volume_aud, buy_unclaimed_volume, comment=""):
-        global BUY_EVENT_COUNTER
-        self.id = BUY_EVENT_COUNTER  # Unique ID for this entry
-        BUY_EVENT_COUNTER += 1
-        self.input_record = input_record
-        self.sell_events = sell_events  # A list of SellEvent which correspond to this buy event
+    __slots__ = ['id', 'input_record', 'sell_events', 'date', 'buy_unclaimed_volume', 'buy_asset', 'buy_volume',
+                 'buy_price_aud', 'comment']
+
+    def __init__(self, date, input_record, sell_events, buy_asset, buy_volume, buy_price_aud, buy_unclaimed_volume, comment="", id=None):
+        self.id = id  # Unique ID for this entry
+        self.input_record = input_record  # The InputRecord this was made from, which outlives it anyway
+        self.sell_events = tuple(sell_events)  # ids of the SellEvent which correspond to this buy event
         self.date = date  # The date this event occured
         self.buy_unclaimed_volume = buy_unclaimed_volume  # The volume of asset which has not been linked to a sell event
         self.buy_asset = buy_asset  # Asset which was sold
         self.buy_volume = buy_volume  # Volume of the asset which was sold
         self.buy_price_aud = buy_price_aud  # Price ($aud per unit) the asset was sold
-        self.buy_volume_aud = buy_volume_aud  # The total $aud volume which was sold
         self.comment = comment
 
-
-def read_input_file(file_name):
-    with open(file_name, newline='') as csvfile:
-        file_reader = csv.DictReader(csvfile, delimiter=',')
-        for row in file_reader:
-            try:
-                new_record = InputRecord(**row)
-                ALL_INPUT_RECORDS.append(new_record)
-            except Exception as e:
-                print("Failed to interpret line: %s" % e)
-                print("--", row)
-                raise
-        logging.debug("loaded %s records from %s" % (len(ALL_INPUT_RECORDS), file_name))
+    @property
+    def buy_volume_aud(self):
+        # The total $aud volume which was bought
+        return self.buy_price_aud * self.buy_volume
 
 
-def read_input_directory(input_folder_path):
-    file_read_counter = 0
-    for file in os.listdir(input_folder_path):
-        if file.endswith(".csv"):
-            file_read_counter += 1
-            read_input_file(os.path.join(input_folder_path, file))
-
+@functools.lru_cache(maxsize=1 << 14)
+def parse_input_date(date):
+    """ Parse an input file date, which may carry the time of the fill. Exports repeat the same few dates many times,
+    so each is only parsed once, and records from the same day share one datetime """
+    for date_format in INPUT_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(date, date_format)
+        except ValueError:
+            continue
+    raise ValueError("date %r does not match any of %s" % (date, ", ".join(INPUT_DATE_FORMATS)))
+
+
+def format_output_date(date):
+    """ Format a date for the csv outputs, with the time of the fill when the input gave one """
+    if price_tools.has_time_of_day(date):
+        return date.strftime("%Y/%m/%d %H:%M:%S")
+    return date.strftime("%Y/%m/%d")
+
+
+def database_date(date):
+    """ Format a date as ISO text for the output database, with the time of the fill when the input gave one """
+    if price_tools.has_time_of_day(date):
+        return date.isoformat(sep=' ')
+    return date.date().isoformat()
+
+
+def read_input_file(run, file_name, workers=0):
+    record_count = 0
+    for input_records in iter_input_chunks(run, [file_name], workers):
+        run.input_records.extend(input_records)
+        record_count += len(input_records)
+    logging.debug("loaded %s records from %s" % (record_count, file_name))
+
+
+def read_input_directory(run, input_folder_path, workers=None, since=None):
+    for input_records in iter_input_chunks(run, list_input_files(input_folder_path), workers, since):
+        run.input_records.extend(input_records)
+    logging.debug("loaded %s records from %s" % (len(run.input_records), input_folder_path))
+
+
+def list_input_files(input_folder_path):
+    return [os.path.join(input_folder_path, file) for file in sorted(os.listdir(input_folder_path)) if file.endswith(".csv")]
+
+
+def split_input_file(file_name, chunk_bytes=None):
+    """ Return the header fieldnames of an input file, and (start, end) byte ranges which split the rows after it
+    into chunks ending on line breaks. Quote characters are counted on the way, so a chunk never ends on a line
+    break inside a quoted field, such as a comment written over several lines """
+    if chunk_bytes is None:
+        chunk_bytes = INPUT_CHUNK_BYTES
+    with open(file_name, 'rb') as input_file:
+        fieldnames = next(csv.reader([input_file.readline().decode('utf-8-sig')]))
+        file_size = os.fstat(input_file.fileno()).st_size
+        chunks = list()
+        start = input_file.tell()
+        quoted = False  # whether the bytes read so far end inside a quoted field
+        while start < file_size:
+            block = input_file.read(min(start + chunk_bytes, file_size) - start)
+            quoted ^= block.count(b'"') % 2 == 1
+            while True:
+                line = input_file.readline()
+                quoted ^= line.count(b'"') % 2 == 1
+                if not quoted or not line:
+                    break
+            end = min(input_file.tell(), file_size)
+            chunks.append((start, end))
+            start = end
+    return fieldnames, chunks
+
+
+def whole_rows_length(data):
+    """ Return how many bytes at the start of data, which starts at a row, are whole rows: up to its last line break
+    outside a quoted field """
+    end = data.rfind(b"\n") + 1
+    while end and data.count(b'"', 0, end) % 2 == 1:
+        end = data.rfind(b"\n", 0, end - 1) + 1
+    return end
+
+
+def parse_input_chunk(file_name, fieldnames, start, end):
+    """ Parse the rows in one byte range of an input file into InputRecord keyword dicts. Runs in pool workers, so
+    it only returns plain data, ids are handed out when the records are built """
+    with open(file_name, 'rb') as input_file:
+        input_file.seek(start)
+        text = input_file.read(end - start).decode()
+    rows = list()
+    for row in csv.DictReader(io.StringIO(text, newline=''), fieldnames=fieldnames, delimiter=','):
+        try:
+            row['date'] = parse_input_date(row['date'])
+            rows.append(row)
+        except Exception as e:
+            print("Failed to interpret line: %s" % e)
+            print("--", row)
+            raise
+    return rows
+
+
+def rows_to_input_records(run, rows):
+    input_records = list()
+    for row in rows:
+        try:
+            input_records.append(InputRecord(id=run.next_input_id(), **row))
+        except Exception as e:
+            print("Failed to interpret line: %s" % e)
+            print("--", row)
+            raise
+    return input_records
+
+
+def iter_parsed_chunks(file_names, workers=None):
+    """ Yield the parsed rows of file_names one chunk at a time, in file order. Chunks are parsed across a pool of
+    worker processes, with a bounded number in flight so a large export is never held in memory at once. workers
+    of None picks a pool size from the input size, 0 or 1 parses in this process """
+    chunk_jobs = list()
+    for file_name in file_names:
+        fieldnames, chunks = split_input_file(file_name)
+        chunk_jobs.extend((file_name, fieldnames, start, end) for start, end in chunks)
+
+    if workers is None:
+        input_bytes = sum(end - start for _, _, start, end in chunk_jobs)
+        workers = os.cpu_count() if input_bytes >= INPUT_PARALLEL_MIN_BYTES else 0
+
+    if (workers or 0) <= 1 or len(chunk_jobs) < 2:
+        for chunk_job in chunk_jobs:
+            yield parse_input_chunk(*chunk_job)
+        return
 
-def input_record_to_buy_event(input_record):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for chunk_job in chunk_jobs:
+            pending.append(executor.submit(parse_input_chunk, *chunk_job))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_input_chunks(run, file_names, workers=None, since=None):
+    """ Yield lists of InputRecord from file_names, one parsed chunk at a time, in file order. Rows dated on or
+    before since are skipped without using up an id """
+    for rows in iter_parsed_chunks(file_names, workers):
+        if since is not None:
+            rows = [row for row in rows if row['date'] > since]
+        yield rows_to_input_records(run, rows)
+
+
+def value_input_records(input_records):
+    """ Price the buy, sell and fee assets of every input record in bulk, with one price_tools.get_prices call per
+    asset. Returns a dict keyed by (asset, date) which the input_record_to_*_event functions accept as prices """
+    asset_dates = dict()
+    for input_record in input_records:
+        for asset in [input_record.buy_asset, input_record.sell_asset, input_record.fee_asset]:
+            asset_dates.setdefault(asset, set()).add(input_record.date)
+
+    prices = dict()
+    for asset, dates in asset_dates.items():
+        dates = sorted(dates)
+        for date, price in zip(dates, price_tools.get_prices(asset, dates)):
+            prices[(asset, date)] = price
+    return prices
+
+
+def input_record_to_buy_event(run, input_record, prices=None):
     # Create a buy_event for each input record
-    buy_price_aud = price_tools.get_price_at_datetime(input_record.buy_asset, input_record.date)
+    if prices is not None:
+        buy_price_aud = prices[(input_record.buy_asset, input_record.date)]
+    else:
+        buy_price_aud = price_tools.get_price_at_datetime(input_record.buy_asset, input_record.date)
     buy_event_dict = dict()
     buy_event_dict['date'] = input_record.date
     buy_event_dict['input_record'] = input_record
@@ -116,17 +408,20 @@ def input_record_to_buy_event(input_record):
     buy_event_dict['buy_asset'] = input_record.buy_asset
     buy_event_dict['buy_volume'] = input_record.buy_volume
     buy_event_dict['buy_price_aud'] = buy_price_aud
-    buy_event_dict['buy_volume_aud'] = buy_price_aud * input_record.buy_volume
     buy_event_dict['buy_unclaimed_volume'] = input_record.buy_volume
     buy_event_dict['comment'] = ""
+    buy_event_dict['id'] = run.next_buy_event_id()
     return BuyEvent(**buy_event_dict)
 
 
-def input_record_to_sell_event(input_record):
+def input_record_to_sell_event(run, input_record, prices=None):
     # Create a SellEvent for a input record
-    sell_price_aud = price_tools.get_price_at_datetime(input_record.sell_asset, input_record.date)
-    fee_price = price_tools.get_price_at_datetime(input_record.fee_asset, input_record.date)
-    fee_aud = fee_price * input_record.unclaimed_fee_volume
+    if prices is not None:
+        sell_price_aud = prices[(input_record.sell_asset, input_record.date)]
+        fee_price = prices[(input_record.fee_asset, input_record.date)]
+    else:
+        sell_price_aud = price_tools.get_price_at_datetime(input_record.sell_asset, input_record.date)
+        fee_price = price_tools.get_price_at_datetime(input_record.fee_asset, input_record.date)
     sell_event_dict = dict()
     sell_event_dict['date'] = input_record.date
     sell_event_dict['input_record'] = input_record
@@ -135,55 +430,88 @@ def input_record_to_sell_event(input_record):
     sell_event_dict['sell_asset'] = input_record.sell_asset
     sell_event_dict['sell_volume'] = input_record.sell_volume
     sell_event_dict['sell_price_aud'] = sell_price_aud
-    sell_event_dict['sell_volume_aud'] = sell_price_aud * input_record.sell_volume
     sell_event_dict['sell_unclaimed_volume'] = input_record.sell_volume
-    sell_event_dict['gross_profit'] = 0
-    sell_event_dict['net_profit'] = 0
-    sell_event_dict['fee_aud'] = fee_aud
+    sell_event_dict['fee_price_aud'] = fee_price
     sell_event_dict['comment'] = ""
+    sell_event_dict['id'] = run.next_sell_event_id()
     return SellEvent(**sell_event_dict)
 
 
-def do_calc_gains():
-    """ The method used to calculate profit is to iterate over all sell events. Each sold asset should be matched
-    to a corresponding buy of an asset. However, we want to minimise profit events when the assets were held for
-    less than 365 days """
-    # Sort by date, recent records first
-    global ALL_BUY_EVENTS
-    global ALL_SELL_EVENTS
-    sorted_buy_records = sorted(ALL_BUY_EVENTS, key=lambda record: record.date)
-    sorted_sell_records = sorted(ALL_SELL_EVENTS, key=lambda record: record.date)
-
-    # Starting at the earliest record
-    for sell_event in sorted_sell_records[::-1]:
-        # if the record sell_asset is AUD, then we ignore the entry (no gains capital gains when we buy with AUD)
-        if sell_event.sell_asset in ['AUD']:
-            continue
+def price_input_records(run, input_records=None):
+    """ Interpret the input records of run, pricing them in bulk, into its buy and sell events. All of them unless
+    input_records, records which have just been added to run, is given """
+    if input_records is None:
+        input_records = run.input_records
+    input_prices = value_input_records(input_records)
+    run.stats['records_priced'] += len(input_records)
+    run.stats['price_lookups'] += len(input_prices)
+    for record in input_records:
+        run.buy_events.append(input_record_to_buy_event(run, record, input_prices))
+        run.sell_events.append(input_record_to_sell_event(run, record, input_prices))
 
-        # Start searching for buy records to match this sell record
-        # Start with buy records that are more than 365 days old, these are cgt deduction candidates
-        cgt_candidate_list = list(filter(lambda record: (sell_event.date - record.date).days > 365, sorted_buy_records))[::-1]
 
-        # Iterate over all CGT candidates, and compose taxable events
-        for buy_event in cgt_candidate_list:
-            # Ignore the dust
-            if sell_event.sell_unclaimed_volume == 0.0:
-                break
-            calculate_taxable_event(sell_event, buy_event)
+def events_to_lots(buy_events, sell_events):
+    """ Return the lot_matching Lot and Sell tuples for buy and sell events. AUD sells are left out, there are no
+    capital gains when we buy with AUD """
+    lots = [lot_matching.Lot(buy_event.id, buy_event.date, buy_event.buy_asset, buy_event.buy_price_aud,
+                             buy_event.buy_unclaimed_volume) for buy_event in buy_events]
+    sells = [lot_matching.Sell(sell_event.id, sell_event.date, sell_event.sell_asset, sell_event.sell_price_aud,
+                               sell_event.sell_unclaimed_volume) for sell_event in sell_events
+             if sell_event.sell_asset not in ['AUD']]
+    return lots, sells
 
-        # Now iterate over all records, starting with the latest. If we cant have a cgt we want a short hold time
-        for buy_event in sorted_buy_records:
-            # Ignore the dust
-            if sell_event.sell_unclaimed_volume == 0.0:
-                break
-            calculate_taxable_event(sell_event, buy_event)
 
+def do_calc_gains(run, strategy="default", workers=None, sell_events=None):
+    """ The method used to calculate profit is to iterate over all sell events. Each sold asset should be matched
+    to a corresponding buy of an asset. Which buys a sell is matched with is decided by the named lot_matching
+    strategy; the default minimises profit events when the assets were held for less than 365 days. Each asset is
+    matched on its own, across a pool of worker processes when workers is more than 1. None, 0 or 1 keeps it in
+    process: the claims are replayed onto the events here either way, so a pool has not yet been seen to pay for its
+    pickling. Given sell_events, only those are matched, against whatever the buys have left unclaimed, like a run
+    carrying on from a snapshot """
+    buy_events = run.buy_events
+    if sell_events is None:
+        sell_events = run.sell_events
+    else:
+        buy_events = [buy_event for buy_event in buy_events if buy_event.buy_unclaimed_volume != 0]
+    lots, sells = events_to_lots(buy_events, sell_events)
+    claims = lot_matching.match_lots_by_asset(strategy, lots, sells, workers or 0, stats=run.stats)
+    run.stats['sells_matched'] += len(sells)
+
+    # Replay the claims onto the events, in the order each asset made them. Assets share no events, so interleaving
+    # them differently from a single serial pass changes nothing
+    buy_events = dict((buy_event.id, buy_event) for buy_event in buy_events)
+    sell_events = dict((sell_event.id, sell_event) for sell_event in sell_events)
+    for sell_id, lot_id, volume in claims:
+        calculate_taxable_event(sell_events[sell_id], buy_events[lot_id], run.stats)
+
+    for sell in sorted(sells, key=lambda sell: sell.date)[::-1]:
+        sell_event = sell_events[sell.id]
         if sell_event.sell_unclaimed_volume != 0:
+            run.stats['sells_unclaimed'] += 1
             logging.error("sell record still has unclaimed sell volume! %s" % sell_event.id)
             logging.error("when did I buy that %.2f %s?" % (sell_event.sell_unclaimed_volume, sell_event.sell_asset))
 
 
-def calculate_taxable_event(sell_event, buy_event):
+def write_strategy_comparison(run, file_name, strategy_names):
+    """ Match the events under each of strategy_names without changing them, and write a summary of the capital
+    gains each strategy gives """
+    lots, sells = events_to_lots(run.buy_events, run.sell_events)
+    summaries = lot_matching.compare_strategies(strategy_names, lots, sells)
+    with open(file_name, 'w', newline='') as csvfile:
+        fieldnames = ['strategy'] + list(lot_matching.summarise_claims([]))
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for strategy_name, summary in summaries.items():
+            write_data = dict()
+            write_data['strategy'] = strategy_name
+            for field, value in summary.items():
+                write_data[field] = value if field == 'claims' else "%.4f" % value
+            writer.writerow(write_data)
+
+
+def calculate_taxable_event(sell_event, buy_event, stats=None):
+    # stats, a Counter, counts the claims linked. The strategies only make claims which pass the checks below
     # Does the record 'buy' asset match this 'sell' asset?
     if sell_event.sell_asset not in buy_event.buy_asset:
         #logging.error("sell_asset does not match buy_asset? This should not occur")
@@ -199,24 +527,29 @@ def calculate_taxable_event(sell_event, buy_event):
         #logging.error("already_claimed")
         return
 
+    if stats is not None:
+        stats['taxable_event_linked'] += 1
+
     # The volume to link
     event_vol = min(sell_event.sell_unclaimed_volume, buy_event.buy_unclaimed_volume)
 
     # Calculate taxable event parameters
     try:
-        sell_event.buy_events.append(buy_event)
+        sell_event.buy_events = add_link(sell_event.buy_events, buy_event.id)
         #sell_event.cost_base_aud += (event_vol / sell_event.sell_volume) * buy_event.buy_price_aud * event_vol
         sell_event.cost_base_aud += buy_event.buy_price_aud * event_vol
         sell_event.sell_unclaimed_volume = round(sell_event.sell_unclaimed_volume - event_vol, 4)
-        sell_event.days_held = (sell_event.date - buy_event.date).days
-        sell_event.calculate_profit()
+        sell_event.days_held = lot_matching.days_held(sell_event.date, buy_event.date)
 
-        buy_event.sell_events.append(sell_event)
+        buy_event.sell_events = add_link(buy_event.sell_events, sell_event.id)
         buy_event.buy_unclaimed_volume = round(buy_event.buy_unclaimed_volume - event_vol, 4)
 
-        sell_event.input_record.sell_events.append(sell_event.id)
+        # A record's links are only ever to its own events, so each is kept once however many claims it makes
+        if not sell_event.input_record.sell_events:
+            sell_event.input_record.sell_events = (sell_event.id,)
         sell_event.input_record.unclaimed_sell_volume -= event_vol
-        buy_event.input_record.buy_events.append(buy_event.id)
+        if not buy_event.input_record.buy_events:
+            buy_event.input_record.buy_events = (buy_event.id,)
         buy_event.input_record.unclaimed_buy_volume -= event_vol
 
     except Exception as e:
@@ -224,9 +557,157 @@ def calculate_taxable_event(sell_event, buy_event):
         raise
 
 
-def write_all_output_files():
+def save_snapshot(run, file_name, as_of=None):
+    """ Save the matching state for a later run to carry on from: every buy lot which still has unclaimed volume,
+    the input records they came from, and the id counters. as_of defaults to the latest record date, and a run
+    which loads the snapshot only reads trades after it """
+    if as_of is None:
+        as_of = max([record.date for record in run.input_records] + [run.snapshot_date or datetime.datetime.min])
+
+    open_lots = list()
+    for buy_event in run.buy_events:
+        # AUD is never matched against, so there is no point carrying it
+        if buy_event.buy_unclaimed_volume == 0 or buy_event.buy_asset in ['AUD']:
+            continue
+        input_record = buy_event.input_record
+        open_lots.append({
+            'id': buy_event.id,
+            'date': buy_event.date.isoformat(),
+            'buy_asset': buy_event.buy_asset,
+            'buy_volume': str(buy_event.buy_volume),
+            'buy_unclaimed_volume': str(buy_event.buy_unclaimed_volume),
+            'buy_price_aud': str(buy_event.buy_price_aud),
+            'buy_volume_aud': str(buy_event.buy_volume_aud),
+            'cost_base_aud': str(buy_event.buy_price_aud * buy_event.buy_unclaimed_volume),
+            'comment': buy_event.comment,
+            'input_record': {
+                'id': input_record.id,
+                'date': input_record.date.isoformat(),
+                'buy_asset': input_record.buy_asset,
+                'buy_volume': str(input_record.buy_volume),
+                'sell_asset': input_record.sell_asset,
+                'sell_volume': str(input_record.sell_volume),
+                'fee_asset': input_record.fee_asset,
+                'fee_volume': str(input_record.fee_volume),
+                'unclaimed_buy_volume': str(input_record.unclaimed_buy_volume),
+                'unclaimed_sell_volume': str(input_record.unclaimed_sell_volume),
+                'comment': input_record.comment,
+            },
+        })
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'as_of': as_of.isoformat(),
+        'input_counter': run.input_counter,
+        'buy_event_counter': run.buy_event_counter,
+        'sell_event_counter': run.sell_event_counter,
+        'open_lots': open_lots,
+    }
+    with open(file_name, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, indent=1)
+    logging.debug("saved %s open lots as of %s to %s" % (len(open_lots), as_of.strftime("%Y/%m/%d"), file_name))
+
+
+def load_snapshot(run, file_name):
+    """ Restore the open buy lots and id counters saved by save_snapshot. The lots are added to run.buy_events with
+    their original ids, so they are matched like any other buy. Returns the snapshot date. Matches made before the
+    snapshot are final, later sells can only claim what was left open """
+    with open(file_name) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    if snapshot['version'] != SNAPSHOT_VERSION:
+        raise ValueError("%s is a version %s snapshot, expected %s" % (file_name, snapshot['version'], SNAPSHOT_VERSION))
+
+    input_records = dict()
+    for lot in snapshot['open_lots']:
+        record_data = lot['input_record']
+        input_record = input_records.get(record_data['id'])
+        if input_record is None:
+            input_record = InputRecord(datetime.datetime.fromisoformat(record_data['date']), record_data['buy_asset'],
+                                       record_data['buy_volume'], record_data['sell_asset'], record_data['sell_volume'],
+                                       record_data['fee_asset'], record_data['fee_volume'], comment=record_data['comment'],
+                                       id=record_data['id'])
+            input_record.unclaimed_buy_volume = Decimal(record_data['unclaimed_buy_volume'])
+            input_record.unclaimed_sell_volume = Decimal(record_data['unclaimed_sell_volume'])
+            input_records[input_record.id] = input_record
+
+        buy_event = BuyEvent(datetime.datetime.fromisoformat(lot['date']), input_record, [], lot['buy_asset'],
+                             Decimal(lot['buy_volume']), Decimal(lot['buy_price_aud']),
+                             Decimal(lot['buy_unclaimed_volume']), comment=lot['comment'], id=lot['id'])
+        run.buy_events.append(buy_event)
+
+    run.input_counter = snapshot['input_counter']
+    run.buy_event_counter = snapshot['buy_event_counter']
+    run.sell_event_counter = snapshot['sell_event_counter']
+    run.snapshot_date = datetime.datetime.fromisoformat(snapshot['as_of'])
+    logging.debug("loaded %s open lots as of %s from %s" % (len(snapshot['open_lots']),
+                                                          run.snapshot_date.strftime("%Y/%m/%d"), file_name))
+    return run.snapshot_date
+
+
+def insert_batched(connection, sql, rows):
+    """ Insert rows, a generator, committing every OUTPUT_DATABASE_BATCH_ROWS so no transaction grows unbounded """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, OUTPUT_DATABASE_BATCH_ROWS))
+        if not batch:
+            return
+        connection.executemany(sql, batch)
+        connection.commit()
+
+
+def write_output_database(run, file_name):
+    """ Write the input records, buy and sell events of run to a SQLite database, with the links from sells to the
+    buys they claimed in sell_buy_links rather than in list cells. Decimals are stored as their exact text and dates
+    as ISO text. Indexes are built after the rows are in, and the database is written to a temporary file first, so
+    a reader never sees half of it """
+    output_dir = os.path.dirname(file_name) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    temp_name = file_name + ".tmp"
+    if os.path.exists(temp_name):
+        os.remove(temp_name)  # left by a run which was killed
+    try:
+        connection = sqlite3.connect(temp_name)
+        try:
+            # The file is thrown away if anything fails, so there is nothing for a journal to protect
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.executescript(OUTPUT_DATABASE_SCHEMA)
+
+            insert_batched(connection, "INSERT INTO input_records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                (record.id, database_date(record.date), record.buy_asset, str(record.buy_volume),
+                 record.sell_asset, str(record.sell_volume), record.fee_asset, str(record.fee_volume),
+                 str(record.unclaimed_buy_volume), str(record.unclaimed_sell_volume), record.comment)
+                for record in run.input_records))
+            insert_batched(connection, "INSERT INTO buy_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                (buy_event.id, database_date(buy_event.date), buy_event.input_record.id,
+                 str(buy_event.buy_unclaimed_volume), buy_event.buy_asset, str(buy_event.buy_volume),
+                 str(buy_event.buy_price_aud), str(buy_event.buy_volume_aud), buy_event.comment)
+                for buy_event in run.buy_events))
+            insert_batched(connection, "INSERT INTO sell_events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                (sell_event.id, database_date(sell_event.date), sell_event.input_record.id,
+                 str(sell_event.cost_base_aud), str(sell_event.sell_unclaimed_volume), sell_event.sell_asset,
+                 str(sell_event.sell_volume), str(sell_event.sell_price_aud), str(sell_event.sell_volume_aud),
+                 str(sell_event.gross_profit), str(sell_event.net_profit), str(sell_event.fee_aud),
+                 sell_event.days_held, sell_event.days_held > 365, sell_event.comment)
+                for sell_event in run.sell_events))
+            insert_batched(connection, "INSERT INTO sell_buy_links VALUES (?, ?, ?)", (
+                (sell_event.id, buy_event_id, position)
+                for sell_event in run.sell_events for position, buy_event_id in enumerate(sell_event.buy_events)))
+
+            connection.executescript(OUTPUT_DATABASE_INDEXES)
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):  # connect can fail before it is made
+            os.remove(temp_name)
+        raise
+
+
+def write_all_output_files(run):
     total_profit = 0
-    for input_record in ALL_INPUT_RECORDS:
+    for input_record in run.input_records:
         pass
         #print("%s - sold %.4f %s, $%.2f AUD profit; %s days held (bought on %s)" % (input_record.date.strftime("%Y-%m-%d"),
         #                                                        input_record.event_volume,
@@ -236,19 +717,20 @@ def write_all_output_files():
         #                                                        input_record.buy_record.date.strftime("%Y-%m-%d")  ) )
         #print("bought for %s, sold for %s" % (event['buy_aud_vol'], event['sell_aud_vol']))
 
-    with open('output_input_events.csv', 'w', newline='') as csvfile:
+    os.makedirs(run.output_dir, exist_ok=True)
+    with open(run.output_path('output_input_events.csv'), 'w', newline='') as csvfile:
         fieldnames = ['id', 'date', 'buy_asset', 'buy_volume', 'sell_asset', 'sell_volume', 'fee_asset', 'fee_volume', 'unclaimed_buy_volume', 'unclaimed_sell_volume', 'sell_events', 'buy_events', 'comment']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
 
-        for input_record in ALL_INPUT_RECORDS:
+        for input_record in run.input_records:
             #cgt_discount = False
             #if input_record.held_days.days > 365:
             #    cgt_discount = True
 
             write_data = dict()
             write_data['id'] = input_record.id
-            write_data['date'] = input_record.date.strftime("%Y/%m/%d")
+            write_data['date'] = format_output_date(input_record.date)
             write_data['buy_asset'] = input_record.buy_asset
             write_data['buy_volume'] = input_record.buy_volume
             write_data['sell_asset'] = input_record.sell_asset
@@ -266,15 +748,13 @@ def write_all_output_files():
 
     #print("total_profit", total_profit)
 
-    with open('output_sell_events.csv', 'w', newline='') as csvfile:
+    with open(run.output_path('output_sell_events.csv'), 'w', newline='') as csvfile:
         fieldnames = ['id', 'date', 'input_record', 'buy_events', 'cost_base_aud', 'sell_unclaimed_volume', 'sell_asset', 'sell_volume', 'sell_price_aud', 'sell_volume_aud', 'gross_profit', 'net_profit', 'fee_aud', 'days_held', 'cgt_discount', 'comment']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
 
-        for sell_record in ALL_SELL_EVENTS:
-            buy_events = []
-            for evt in sell_record.buy_events:
-                buy_events.append(evt.id)
+        for sell_record in run.sell_events:
+            buy_events = list(sell_record.buy_events)
 
             cgt_discount = False
             if sell_record.days_held > 365:
@@ -282,7 +762,7 @@ def write_all_output_files():
 
             write_data = dict()
             write_data['id'] = sell_record.id
-            write_data['date'] = sell_record.date.strftime("%Y/%m/%d")
+            write_data['date'] = format_output_date(sell_record.date)
             write_data['input_record'] = sell_record.input_record.id
             write_data['buy_events'] = buy_events
             write_data['cost_base_aud'] = "%.4f" % sell_record.cost_base_aud
@@ -299,19 +779,17 @@ def write_all_output_files():
             write_data['comment'] = sell_record.comment
             writer.writerow(write_data)
 
-    with open('output_buy_events.csv', 'w', newline='') as csvfile:
+    with open(run.output_path('output_buy_events.csv'), 'w', newline='') as csvfile:
         fieldnames = ['id', 'date', 'input_record', 'sell_events', 'buy_unclaimed_volume', 'buy_asset', 'buy_volume', 'buy_price_aud', 'buy_volume_aud', 'comment']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
 
-        for buy_record in ALL_BUY_EVENTS:
-            sell_events = []
-            for evt in buy_record.sell_events:
-                sell_events.append(evt.id)
+        for buy_record in run.buy_events:
+            sell_events = list(buy_record.sell_events)
 
             write_data = dict()
             write_data['id'] = buy_record.id
-            write_data['date'] = buy_record.date.strftime("%Y/%m/%d")
+            write_data['date'] = format_output_date(buy_record.date)
             write_data['input_record'] = buy_record.input_record.id
             write_data['sell_events'] = sell_events
             write_data['buy_unclaimed_volume'] = "%.4f" % buy_record.buy_unclaimed_volume
@@ -323,14 +801,102 @@ def write_all_output_files():
             writer.writerow(write_data)
 
 
-if __name__ == '__main__':
-    read_input_directory("input/")
-    # interpret all input records
-    for record in ALL_INPUT_RECORDS:
-        ALL_BUY_EVENTS.append(input_record_to_buy_event(record))
-        ALL_SELL_EVENTS.append(input_record_to_sell_event(record))
-
-    do_calc_gains()
-    write_all_output_files()
+def write_outputs(run, output_format="csv"):
+    """ Write the outputs of run in output_format, one of OUTPUT_FORMATS """
+    if output_format == 'sqlite':
+        write_output_database(run, run.output_path(OUTPUT_DATABASE))
+    else:
+        write_all_output_files(run)
+
+
+def run_portfolio(run, strategy="default", workers=None, snapshot_in=None, snapshot_out=None, compare_strategies=None,
+                  profile_out=None, output_format="csv"):
+    """ Work out one portfolio from its input directory to its output files, csv files or a SQLite database by
+    output_format. Each phase is timed, and the timings and counters are written to profile_out as json when it is
+    given """
+    # The strategy comparison and the profile are written before or besides the outputs, so make the directory first
+    os.makedirs(run.output_dir, exist_ok=True)
+    since = None
+    if snapshot_in:
+        since = timed_phase(run, 'ingest', load_snapshot, run, snapshot_in)
+    timed_phase(run, 'ingest', read_input_directory, run, run.input_dir, workers=workers, since=since)
+    run.stats['input_records'] += len(run.input_records)
+    timed_phase(run, 'pricing', price_input_records, run)
+
+    if compare_strategies is not None:
+        timed_phase(run, 'strategy_comparison', write_strategy_comparison, run,
+                    run.output_path('output_strategy_comparison.csv'), compare_strategies or list(lot_matching.STRATEGIES))
+    timed_phase(run, 'matching', do_calc_gains, run, strategy, workers=workers)
+    timed_phase(run, 'output', write_outputs, run, output_format)
+    if snapshot_out:
+        timed_phase(run, 'output', save_snapshot, run, snapshot_out)
+    if profile_out:
+        write_profile(run, profile_out)
+    return run
+
+
+def run_batch_portfolio(input_dir, output_dir, options):
+    if options.get('profile_out'):
+        # Each portfolio writes its own profile, next to its outputs
+        options = dict(options, profile_out=os.path.join(output_dir, options['profile_out']))
+    run = run_portfolio(TaxRun(input_dir, output_dir), workers=0, **options)
+    return input_dir, output_dir, len(run.input_records)
+
+
+def run_batch(input_dirs, output_root, workers=None, **options):
+    """ Work out many portfolios, one per input directory, each writing its outputs to a directory of the same name
+    under output_root. Prices are loaded once up front and shared, with forked workers sharing the mapped price
+    cache. workers of None uses a process per core, 0 or 1 works through them in this process. Returns a list of
+    (input directory, output directory, record count) """
+    output_dirs = [os.path.join(output_root, os.path.basename(os.path.normpath(input_dir))) for input_dir in input_dirs]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("input directories must have different names, their outputs would overwrite each other")
+
+    price_tools.preload()
+    if workers is None:
+        workers = os.cpu_count()
+    if (workers or 0) <= 1 or len(input_dirs) < 2:
+        return [run_batch_portfolio(input_dir, output_dir, options) for input_dir, output_dir in zip(input_dirs, output_dirs)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(input_dirs))) as executor:
+        futures = [executor.submit(run_batch_portfolio, input_dir, output_dir, options)
+                   for input_dir, output_dir in zip(input_dirs, output_dirs)]
+        return [future.result() for future in futures]
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calculate capital gains from the trades in an input directory")
+    parser.add_argument("--input-dir", default="input/", help="directory of input trade csv files")
+    parser.add_argument("--output-dir", default=".", help="directory to write the output files to")
+    parser.add_argument("--batch", nargs="+", metavar="INPUT_DIR",
+                        help="work out one portfolio per input directory, writing to OUTPUT_DIR/<input dir name>/")
+    parser.add_argument("--load-snapshot", help="carry on from a snapshot saved by an earlier run, reading only later trades")
+    parser.add_argument("--save-snapshot", help="save the open lots after this run, for next year's run to load")
+    parser.add_argument("--strategy", default="default", choices=list(lot_matching.STRATEGIES),
+                        help="how sells are matched with buy lots")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes to parse input and match assets with, 0 for none (default: parse by input size, "
+                             "match in process)")
+    parser.add_argument("--compare-strategies", nargs="*", metavar="STRATEGY", choices=list(lot_matching.STRATEGIES),
+                        help="also write output_strategy_comparison.csv, comparing these strategies (default all)")
+    parser.add_argument("--output-format", default="csv", choices=OUTPUT_FORMATS,
+                        help="write csv files, or a single %s database of indexed tables" % OUTPUT_DATABASE)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time spent in each phase and the hot path counters to FILE as json, with "
+                             "--batch FILE is written in each portfolio's output directory")
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.load_snapshot or args.save_snapshot:
+            parser.error("snapshots are per portfolio, they can not be used with --batch")
+        for input_dir, output_dir, record_count in run_batch(args.batch, args.output_dir, workers=args.workers,
+                                                             strategy=args.strategy,
+                                                             compare_strategies=args.compare_strategies,
+                                                             profile_out=args.profile,
+                                                             output_format=args.output_format):
+            logging.info("%s: %s records, written to %s" % (input_dir, record_count, output_dir))
+    else:
+        run_portfolio(TaxRun(args.input_dir, args.output_dir), args.strategy, workers=args.workers,
+                      snapshot_in=args.load_snapshot, snapshot_out=args.save_snapshot,
+                      compare_strategies=args.compare_strategies, profile_out=args.profile,
+                      output_format=args.output_format)
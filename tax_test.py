@@ -1,14 +1,29 @@
+import os
+import csv
+import json
+import shutil
+import threading
+import urllib.request
+import sqlite3
 import unittest
+import tempfile
 import datetime
+from decimal import Decimal
 import price_tools
+import tax_my_shit_up
+import lot_matching
+import what_if_service
+import bench
 
 
 class TestTaxMethods(unittest.TestCase):
     def test_get_price_at_datetime_1(self):
         date = datetime.datetime.strptime("2015-09-18", "%Y-%m-%d")
         asset_string = "BTC"
+        # 235.38200025999998 BTC_USDT
+        # 0.7225 AUD_USDT, 1 AUD buys 0.7225 USDT
         price = price_tools.get_price_at_datetime(asset_string, date)
-        self.assertAlmostEqual(235.38200026, float(price))
+        self.assertAlmostEqual(325.78823566, float(price))
 
     def test_get_price_at_datetime_2(self):
         date = datetime.datetime.strptime("2015-09-18", "%Y-%m-%d")
@@ -23,8 +38,463 @@ class TestTaxMethods(unittest.TestCase):
         # 235.38200025999998 BTC_USDT
         # infers
         # 1usd buys 0.87145831029260189656830007799999 eth
+        # 0.7225 AUD_USDT, 1 AUD buys 0.7225 USDT
         price = price_tools.get_price_at_datetime(asset_string, date)
-        self.assertAlmostEqual(0.87145831, float(price))
+        self.assertAlmostEqual(1.20617067, float(price))
+
+    def test_conversion_path(self):
+        self.assertEqual([('ETH_BTC', False), ('BTC_USDT', False), ('AUD_USDT', True)],
+                         price_tools.get_conversion_path("ETH"))
+        self.assertEqual([], price_tools.get_conversion_path("AUD"))
+        with self.assertRaises(KeyError):
+            price_tools.get_conversion_path("NOPE")
+
+    def test_gaps_are_forward_filled(self):
+        # AUD_USDT has no bars from 2016-10-28 to 2016-10-30
+        friday = datetime.datetime.strptime("2016-10-27", "%Y-%m-%d")
+        sunday = datetime.datetime.strptime("2016-10-30", "%Y-%m-%d")
+        self.assertEqual(price_tools.get_price_at_datetime("USDT", friday),
+                         price_tools.get_price_at_datetime("USDT", sunday))
+
+    def test_stale_prices_are_refused(self):
+        series = price_tools.get_pair_data("BTC_USDT")
+        last_day = series.first_ordinal + len(series) - 1
+        series.mid_at(last_day + 3, max_stale_days=3)
+        with self.assertRaises(price_tools.PriceLookupError):
+            series.mid_at(last_day + 4, max_stale_days=3)
+        with self.assertRaises(price_tools.PriceLookupError):
+            series.mid_at(series.first_ordinal - 1)
+
+    def test_get_prices(self):
+        dates = [datetime.datetime.strptime(date, "%Y-%m-%d") for date in ["2015-09-18", "2016-01-05", "2015-09-18"]]
+        prices = price_tools.get_prices("ETH", dates)
+        self.assertEqual([price_tools.get_price_at_datetime("ETH", date) for date in dates], prices)
+
+    def test_pairs_load_on_demand(self):
+        price_tools.clear_price_data()
+        date = datetime.datetime.strptime("2015-09-18", "%Y-%m-%d")
+        price_tools.get_price_at_datetime("BTC", date)
+        self.assertEqual(['AUD_USDT', 'BTC_USDT'], sorted(price_tools.PRICE_DATA))
+        price_tools.preload(['LTC_BTC'])
+        self.assertIn('LTC_BTC', price_tools.PRICE_DATA)
+
+    def test_unknown_pair(self):
+        with self.assertRaises(KeyError):
+            price_tools.get_pair_data('NOPE_BTC')
+
+
+class TestPriceCache(unittest.TestCase):
+    def test_cache_rebuilt_when_csv_changes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            csv_filename = os.path.join(folder, "ABC_BTC.csv")
+            with open(csv_filename, 'w') as csvfile:
+                csvfile.write("2016-01-02,1,4,2,1,0\n2016-01-01,1,2,1,1,0\n")
+            cache_dir = price_tools.PRICE_CACHE_DIR
+            price_tools.PRICE_CACHE_DIR = os.path.join(folder, "cache")
+            try:
+                series = price_tools.load_price_cache(csv_filename, "ABC_BTC")
+                self.assertEqual(1.5, series.mid_at(datetime.date(2016, 1, 1).toordinal()))
+                self.assertEqual(3.0, series.mid_at(datetime.date(2016, 1, 2).toordinal()))
+
+                with open(csv_filename, 'w') as csvfile:
+                    csvfile.write("2016-01-01,1,8,2,1,0\n")
+                os.utime(csv_filename, ns=(0, 0))
+                series = price_tools.load_price_cache(csv_filename, "ABC_BTC")
+                self.assertEqual(1, len(series))
+                self.assertEqual(5.0, series.mid_at(datetime.date(2016, 1, 1).toordinal()))
+            finally:
+                price_tools.PRICE_CACHE_DIR = cache_dir
+
+    def test_touched_csv_with_unwritable_cache(self):
+        def unwritable(*args):
+            raise PermissionError("read only")
+
+        with tempfile.TemporaryDirectory() as folder:
+            csv_filename = os.path.join(folder, "ABC_BTC.csv")
+            with open(csv_filename, 'w') as csvfile:
+                csvfile.write("2016-01-01,1,2,1,1,0\n")
+            cache_dir, write_price_cache = price_tools.PRICE_CACHE_DIR, price_tools.write_price_cache
+            price_tools.PRICE_CACHE_DIR = os.path.join(folder, "cache")
+            try:
+                price_tools.load_price_cache(csv_filename, "ABC_BTC")
+                os.utime(csv_filename, ns=(0, 0))  # as a checkout would, the contents are the same
+                price_tools.write_price_cache = unwritable
+                series = price_tools.load_price_cache(csv_filename, "ABC_BTC")
+                self.assertEqual(1.5, series.mid_at(datetime.date(2016, 1, 1).toordinal()))
+            finally:
+                price_tools.PRICE_CACHE_DIR, price_tools.write_price_cache = cache_dir, write_price_cache
+
+
+class TestIntradayPrices(unittest.TestCase):
+    def test_parse_sorts_and_dedupes(self):
+        first_ordinal, times, mids = price_tools.parse_intraday_csv(
+            b"2015-09-18 11:00:00,0,4,2,0,0\n2015-09-18 10:00:00,0,2,1,0,0\n2015-09-18 11:00:00,0,8,2,0,0\n")
+        self.assertEqual([price_tools.datetime_to_seconds(datetime.datetime(2015, 9, 18, hour)) for hour in [10, 11]],
+                         list(times))
+        self.assertEqual([1.5, 5.0], list(mids))
+        unix_time = price_tools.parse_bar_time("1442570400")
+        self.assertEqual(price_tools.datetime_to_seconds(datetime.datetime(2015, 9, 18, 10)), unix_time)
+
+    def test_fills_are_priced_from_their_bar(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "BTC_USDT.csv"), 'w') as csvfile:
+                csvfile.write("2015-09-18 10:00:00,0,2,1,0,0\n2015-09-18 11:00:00,0,301,299,0,0\n")
+            intraday_dir, cache_dir = price_tools.PRICE_INTRADAY_DIR, price_tools.PRICE_CACHE_DIR
+            price_tools.PRICE_INTRADAY_DIR = folder
+            price_tools.PRICE_CACHE_DIR = os.path.join(folder, "cache")
+            price_tools.clear_price_data()
+            try:
+                day = datetime.datetime(2015, 9, 18)
+                usdt = price_tools.get_price_at_datetime("USDT", day)
+                self.assertEqual(Decimal(1.5) * usdt, price_tools.get_price_at_datetime("BTC", day.replace(hour=10, minute=30)))
+                self.assertEqual(Decimal(300) * usdt, price_tools.get_price_at_datetime("BTC", day.replace(hour=11, minute=59)))
+                # too long after the last bar, and before the first, the daily bar is used
+                daily = price_tools.get_price_at_datetime("BTC", day)
+                self.assertEqual(daily, price_tools.get_price_at_datetime("BTC", day.replace(hour=14)))
+                self.assertEqual(daily, price_tools.get_price_at_datetime("BTC", day.replace(hour=9)))
+                self.assertIsInstance(price_tools.INTRADAY_DATA["BTC_USDT"].times, memoryview)
+            finally:
+                price_tools.PRICE_INTRADAY_DIR, price_tools.PRICE_CACHE_DIR = intraday_dir, cache_dir
+                price_tools.clear_price_data()
+
+    def test_input_times(self):
+        self.assertEqual(datetime.datetime(2016, 6, 12, 14, 30), tax_my_shit_up.parse_input_date("12/06/2016 14:30"))
+        self.assertEqual(datetime.datetime(2016, 6, 12), tax_my_shit_up.parse_input_date("12/06/2016"))
+        with self.assertRaises(ValueError):
+            tax_my_shit_up.parse_input_date("2016-06-12")
+
+
+class TestInput(unittest.TestCase):
+    def test_chunked_parse_matches_whole_file(self):
+        file_names = ["input/sample.csv"]
+        whole = [row for rows in tax_my_shit_up.iter_parsed_chunks(file_names, 0) for row in rows]
+        fieldnames, chunks = tax_my_shit_up.split_input_file(file_names[0], chunk_bytes=10)
+        self.assertEqual(len(whole), len(chunks))
+        pieces = [row for start, end in chunks for row in tax_my_shit_up.parse_input_chunk(file_names[0], fieldnames, start, end)]
+        self.assertEqual(whole, pieces)
+
+    def test_chunks_keep_quoted_line_breaks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "quoted.csv")
+            with open("input/sample.csv") as sample, open(file_name, 'w') as input_file:
+                input_file.write(sample.read().rstrip("\n"))
+                input_file.write('\n01/03/2017,AUD,100,ETH,1.5,aud,0.1,"over\ntwo ""lines""\n"\n02/03/2017,AUD,100,BTC,0.5,aud,0.1,later\n')
+            with open(file_name, newline='') as input_file:
+                whole = list(csv.DictReader(input_file))
+            for chunk_bytes in range(1, 40):
+                fieldnames, chunks = tax_my_shit_up.split_input_file(file_name, chunk_bytes=chunk_bytes)
+                pieces = [row for start, end in chunks
+                          for row in tax_my_shit_up.parse_input_chunk(file_name, fieldnames, start, end)]
+                self.assertEqual([row['comment'] for row in whole], [row['comment'] for row in pieces])
+            with open(file_name, 'rb') as input_file:
+                data = input_file.read()
+            cut = data.index(b"two")
+            self.assertEqual(data.rindex(b"\n", 0, data.index(b'"over')) + 1, tax_my_shit_up.whole_rows_length(data[:cut]))
+
+    def test_dates_are_shared(self):
+        self.assertIs(tax_my_shit_up.parse_input_date("12/06/2016"), tax_my_shit_up.parse_input_date("12/06/2016"))
+
+
+class TestTaxRun(unittest.TestCase):
+    def test_runs_are_isolated(self):
+        with tempfile.TemporaryDirectory() as folder:
+            runs = [tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun("input/", os.path.join(folder, name)), workers=0)
+                    for name in ["a", "b"]]
+            for run in runs:
+                self.assertEqual(list(range(4)), [record.id for record in run.input_records])
+                self.assertEqual(list(range(4)), [event.id for event in run.buy_events])
+            with open(os.path.join(folder, "a", "output_sell_events.csv")) as a, \
+                    open(os.path.join(folder, "b", "output_sell_events.csv")) as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_links_grow_from_tuples(self):
+        links = ()
+        for event_id in range(tax_my_shit_up.LINK_TUPLE_MAX):
+            links = tax_my_shit_up.add_link(links, event_id)
+        self.assertIsInstance(links, tuple)
+        links = tax_my_shit_up.add_link(links, 99)
+        self.assertEqual(list(range(tax_my_shit_up.LINK_TUPLE_MAX)) + [99], list(links))
+
+    def test_snapshot_round_trip(self):
+        header = "date,buy_asset,buy_volume,sell_asset,sell_volume,fee_asset,fee_volume,comment\n"
+        year_1 = "12/03/2016,ETH,22,AUD,50.02,aud,18.1,a\n12/06/2016,AUD,2523.9104,ETH,5.06,aud,10.09,b\n"
+        year_2 = "11/02/2017,BTC,2.1,ETH,11.21,btc,0.03,c\n12/08/2017,ETH,92.9103,AUD,0.19,aud,0.37,d\n"
+        with tempfile.TemporaryDirectory() as folder:
+            for name, rows in [("year_1", year_1), ("year_2", year_1 + year_2)]:
+                os.makedirs(os.path.join(folder, name))
+                with open(os.path.join(folder, name, "trades.csv"), 'w') as input_file:
+                    input_file.write(header + rows)
+            snapshot = os.path.join(folder, "lots.json")
+            first = tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun(os.path.join(folder, "year_1"), folder),
+                                                 workers=0, snapshot_out=snapshot)
+            run = tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun(os.path.join(folder, "year_2"), folder),
+                                               workers=0, snapshot_in=snapshot)
+
+            # the year 1 rows are skipped without using up ids, and the counters carry on
+            self.assertEqual([2, 3], [record.id for record in run.input_records])
+            self.assertEqual([0, 2, 3], [event.id for event in run.buy_events])
+            self.assertEqual([2, 3], [event.id for event in run.sell_events])
+            self.assertEqual((4, 4, 4), (run.input_counter, run.buy_event_counter, run.sell_event_counter))
+            # the year 2 sell claims what was left of the year 1 lot
+            eth_lot = run.buy_events[0]
+            self.assertEqual(first.buy_events[0].buy_price_aud, eth_lot.buy_price_aud)
+            self.assertEqual([0], list(run.sell_events[0].buy_events))
+            self.assertEqual(Decimal("5.73"), eth_lot.buy_unclaimed_volume)
+
+            with open(snapshot) as snapshot_file:
+                saved = json.load(snapshot_file)
+            saved['version'] += 1
+            with open(snapshot, 'w') as snapshot_file:
+                json.dump(saved, snapshot_file)
+            with self.assertRaises(ValueError):
+                tax_my_shit_up.load_snapshot(tax_my_shit_up.TaxRun(), snapshot)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as folder:
+            run = tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun("input/", folder), workers=0,
+                                               profile_out=os.path.join(folder, "profile.json"))
+            with open(os.path.join(folder, "profile.json")) as profile_file:
+                report = json.load(profile_file)
+        self.assertEqual(['ingest', 'pricing', 'matching', 'output'], list(report['phase_seconds']))
+        counters = report['counters']
+        self.assertEqual(4, counters['input_records'])
+        self.assertNotIn('taxable_event_already_claimed', counters)  # matching never replays a rejected claim
+        linked = sum(len(sell_event.buy_events) for sell_event in run.sell_events)
+        self.assertEqual(linked, counters['taxable_event_linked'])
+        self.assertGreaterEqual(counters['lots_scanned'], linked)
+
+    def test_compare_strategies_to_new_output_dir(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output_dir = os.path.join(folder, "new", "out")
+            tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun("input/", output_dir), workers=0,
+                                         compare_strategies=["fifo", "lifo"])
+            self.assertIn("output_strategy_comparison.csv", os.listdir(output_dir))
+
+    def test_output_dates_keep_the_time(self):
+        self.assertEqual("2017/01/01", tax_my_shit_up.format_output_date(datetime.datetime(2017, 1, 1)))
+        self.assertEqual("2017/01/01 10:30:00", tax_my_shit_up.format_output_date(datetime.datetime(2017, 1, 1, 10, 30)))
+        self.assertEqual("2017-01-01", tax_my_shit_up.database_date(datetime.datetime(2017, 1, 1)))
+        self.assertEqual("2017-01-01 10:30:00", tax_my_shit_up.database_date(datetime.datetime(2017, 1, 1, 10, 30)))
+
+    def test_output_database(self):
+        with tempfile.TemporaryDirectory() as folder:
+            run = tax_my_shit_up.run_portfolio(tax_my_shit_up.TaxRun("input/", folder), workers=0, output_format="sqlite")
+            self.assertEqual(["output.sqlite"], os.listdir(folder))
+            connection = sqlite3.connect(os.path.join(folder, "output.sqlite"))
+            try:
+                links = connection.execute("SELECT sell_event, buy_event FROM sell_buy_links ORDER BY sell_event, position").fetchall()
+                self.assertEqual([(sell_event.id, buy_event_id) for sell_event in run.sell_events
+                                  for buy_event_id in sell_event.buy_events], links)
+                sell_event = run.sell_events[-1]
+                cost_base_aud, = connection.execute("SELECT cost_base_aud FROM sell_events WHERE id = ?", (sell_event.id,)).fetchone()
+                self.assertEqual(sell_event.cost_base_aud, Decimal(cost_base_aud))
+            finally:
+                connection.close()
+
+
+class TestWhatIfService(unittest.TestCase):
+    def open_lots(self, run):
+        return sorted((event.id, event.buy_unclaimed_volume) for event in run.buy_events
+                      if event.buy_unclaimed_volume != 0 and event.buy_asset != 'AUD')
+
+    def test_appended_trades_are_matched(self):
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copy("input/sample.csv", folder)
+            state = what_if_service.WhatIfState(folder, strategy="fifo")
+            self.assertEqual(4, len(state.run.input_records))
+            with open(os.path.join(folder, "sample.csv"), 'a') as input_file:
+                input_file.write("\n01/03/2017,AUD,100,ETH,1.5,aud,0.1,later\n02/03/2017,AUD,100,BTC,0.")
+            self.assertEqual(1, state.refresh())
+            with open(os.path.join(folder, "sample.csv"), 'a') as input_file:
+                input_file.write("5,aud,0.1,later\n")
+            self.assertEqual(1, state.refresh())
+
+            run = tax_my_shit_up.TaxRun(folder, folder)
+            tax_my_shit_up.read_input_directory(run, folder, 0)
+            tax_my_shit_up.price_input_records(run)
+            tax_my_shit_up.do_calc_gains(run, "fifo", 0)
+            self.assertEqual(self.open_lots(run), self.open_lots(state.run))
+
+    def test_failed_refresh_keeps_nothing(self):
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copy("input/sample.csv", folder)
+            file_name = os.path.join(folder, "sample.csv")
+            state = what_if_service.WhatIfState(folder, strategy="fifo")
+            status = state.status()
+            with open(file_name) as input_file:
+                original = input_file.read()
+            with open(file_name, 'a') as input_file:
+                input_file.write("\n01/03/2017,AUD,100,ETH,1.5,aud,0.1,later\n02/03/2017,AUD,100,NOPRICE,1,aud,0.1,later\n")
+            with self.assertRaises(price_tools.PriceLookupError):
+                state.refresh()
+            self.assertEqual(status, state.status())
+            self.assertEqual(4, len(state.run.buy_events))
+
+            # once the bad trade is taken out again, the good one is still picked up, with the ids it would have had
+            with open(file_name, 'w') as input_file:
+                input_file.write(original + "\n01/03/2017,AUD,100,ETH,1.5,aud,0.1,later\n")
+            self.assertEqual(1, state.refresh())
+            run = tax_my_shit_up.TaxRun(folder, folder)
+            tax_my_shit_up.read_input_directory(run, folder, 0)
+            tax_my_shit_up.price_input_records(run)
+            tax_my_shit_up.do_calc_gains(run, "fifo", 0)
+            self.assertEqual(self.open_lots(run), self.open_lots(state.run))
+
+    def test_bad_trade_leaves_queries_answered(self):
+        with tempfile.TemporaryDirectory() as folder:
+            shutil.copy("input/sample.csv", folder)
+            state = what_if_service.WhatIfState(folder)
+            with open(os.path.join(folder, "sample.csv"), 'a') as input_file:
+                input_file.write("\n02/03/2017,AUD,100,NOPRICE,1,aud,0.1,later\n")
+            server = what_if_service.make_server(state, port=0)
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            try:
+                url = "http://127.0.0.1:%s/status" % server.server_address[1]
+                with urllib.request.urlopen(url) as response:
+                    status = json.load(response)
+            finally:
+                thread.join()
+                server.server_close()
+        self.assertEqual(4, status['input_records'])
+        self.assertIn("NOPRICE", status['last_refresh_error'])
+
+    def test_query_validation(self):
+        state = what_if_service.WhatIfState("input/")
+        sell = what_if_service.query_sell(state, {'asset': 'eth', 'volume': '1', 'date': '2017-06-01'})
+        self.assertEqual("ETH", sell['asset'])
+        for volume in ['NaN', 'Infinity', '0', '-1']:
+            with self.assertRaises(ValueError):
+                what_if_service.query_sell(state, {'asset': 'ETH', 'volume': volume, 'date': '2017-06-01'})
+
+    def test_queries(self):
+        state = what_if_service.WhatIfState("input/")
+        date = datetime.datetime(2017, 6, 1)
+        open_lots = self.open_lots(state.run)
+        sell = state.hypothetical_sell("ETH", Decimal("3"), date)
+        self.assertEqual(open_lots, self.open_lots(state.run))
+        self.assertEqual(Decimal(0), sell['unmatched_volume'])
+        self.assertEqual(sell['proceeds_aud'] - sell['cost_base_aud'], sum(lot['gain'] for lot in sell['lots']))
+        unrealised = state.unrealised_gains(date, "ETH")['assets']['ETH']
+        open_events = [state.run.buy_events[lot_id] for lot_id, volume in open_lots]
+        self.assertEqual(sum(event.buy_unclaimed_volume for event in open_events
+                             if event.buy_asset == "ETH" and event.date <= date), unrealised['volume'])
+
+        server = what_if_service.make_server(state, port=0)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%s/status" % server.server_address[1]
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(4, json.load(response)['input_records'])
+        finally:
+            thread.join()
+            server.server_close()
+
+
+class TestLotMatching(unittest.TestCase):
+    def make_lot(self, lot_id, date_string, price="1", asset="ETH", volume="1"):
+        date = datetime.datetime.strptime(date_string, "%Y-%m-%d")
+        return lot_matching.Lot(lot_id, date, asset, Decimal(price), Decimal(volume))
+
+    def make_sell(self, sell_id, date_string, price="10", asset="ETH", volume="1"):
+        date = datetime.datetime.strptime(date_string, "%Y-%m-%d")
+        return lot_matching.Sell(sell_id, date, asset, Decimal(price), Decimal(volume))
+
+    def claimed_lots(self, strategy_name, lots, sells):
+        return [lot.id for sell, lot, volume in lot_matching.match_lots(strategy_name, lots, sells)]
+
+    def test_open_lots_order(self):
+        lots = [self.make_lot(0, "2016-03-01"), self.make_lot(1, "2016-01-01"), self.make_lot(2, "2016-02-01", asset="BTC")]
+        index = lot_matching.BuyLotIndex(lots, dict((lot.id, lot.volume) for lot in lots))
+        cutoff = datetime.datetime.strptime("2016-03-01", "%Y-%m-%d")
+        self.assertEqual([lots[1]], list(index.open_lots("ETH", cutoff)))
+        self.assertEqual([lots[0], lots[1]], list(index.open_lots("ETH", cutoff, newest_first=True, inclusive=True)))
+
+    def test_claimed_lots_are_dropped(self):
+        lots = [self.make_lot(0, "2016-01-01"), self.make_lot(1, "2016-02-01"), self.make_lot(2, "2016-03-01")]
+        remaining = dict((lot.id, lot.volume) for lot in lots)
+        index = lot_matching.BuyLotIndex(lots, remaining)
+        cutoff = datetime.datetime.strptime("2017-01-01", "%Y-%m-%d")
+        for lot in index.open_lots("ETH", cutoff):
+            remaining[lot.id] = Decimal(0)
+            break
+        self.assertEqual([lots[1], lots[2]], list(index.open_lots("ETH", cutoff)))
+        self.assertEqual([lots[2], lots[1]], list(index.open_lots("ETH", cutoff, newest_first=True)))
+
+    def test_strategies(self):
+        lots = [self.make_lot(0, "2015-01-01", price="4"), self.make_lot(1, "2016-06-01", price="5"),
+                self.make_lot(2, "2016-07-01", price="3"), self.make_lot(3, "2016-09-01", price="1")]
+        sells = [self.make_sell(0, "2016-08-01", volume="1.5")]
+        self.assertEqual([0, 1], self.claimed_lots("default", lots, sells))
+        self.assertEqual([0, 1], self.claimed_lots("fifo", lots, sells))
+        self.assertEqual([2, 1], self.claimed_lots("lifo", lots, sells))
+        self.assertEqual([1, 0], self.claimed_lots("hifo", lots, sells))
+        # a gain of 6 on the discounted lot is taxed as 3, less than the 5 on the dearest recent lot
+        self.assertEqual([0, 1], self.claimed_lots("min-tax", lots, sells))
+
+    def test_discount_counts_calendar_days(self):
+        bought = datetime.datetime(2017, 1, 1, 10, 0)
+        sold = datetime.datetime(2018, 1, 2, 9, 0)
+        self.assertEqual(366, lot_matching.days_held(sold, bought))
+        self.assertTrue(lot_matching.is_cgt_discounted(sold, bought))
+        # the default strategy claims the newest discounted lot first, so the lot bought at 10:00 goes before an older one
+        lots = [lot_matching.Lot(0, bought, "ETH", Decimal(1), Decimal(1)), self.make_lot(1, "2016-12-01")]
+        sells = [lot_matching.Sell(0, sold, "ETH", Decimal(10), Decimal(1))]
+        self.assertEqual([0], self.claimed_lots("default", lots, sells))
+
+    def test_match_by_asset_in_pool(self):
+        lots = [self.make_lot(0, "2016-01-01"), self.make_lot(1, "2016-02-01", asset="BTC"),
+                self.make_lot(2, "2016-03-01", volume="2"), self.make_lot(3, "2016-04-01", asset="BTC")]
+        sells = [self.make_sell(0, "2016-05-01", volume="2.5"), self.make_sell(1, "2016-05-01", asset="BTC"),
+                 self.make_sell(2, "2017-05-01")]
+        serial = [(sell.id, lot.id, volume) for sell, lot, volume in lot_matching.match_lots("default", lots, sells)]
+        pooled = lot_matching.match_lots_by_asset("default", lots, sells, workers=2)
+        self.assertEqual(sorted(serial), sorted(pooled))
+
+    def test_compare_strategies(self):
+        lots = [self.make_lot(0, "2015-01-01", price="4"), self.make_lot(1, "2016-06-01", price="5")]
+        sells = [self.make_sell(0, "2016-08-01", volume="1")]
+        summaries = lot_matching.compare_strategies(["fifo", "hifo"], lots, sells)
+        self.assertEqual(Decimal(3), summaries["fifo"]["net_capital_gain"])
+        self.assertEqual(Decimal(5), summaries["hifo"]["net_capital_gain"])
+
+
+
+class TestBench(unittest.TestCase):
+    def test_generated_trades_match(self):
+        with tempfile.TemporaryDirectory() as folder:
+            bench.generate_trades(os.path.join(folder, "bench.csv"), 200, seed=1)
+            run = tax_my_shit_up.TaxRun(folder, folder)
+            tax_my_shit_up.read_input_directory(run, folder, 0)
+            tax_my_shit_up.price_input_records(run)
+            tax_my_shit_up.do_calc_gains(run, "fifo", 0)
+            self.assertEqual(200, len(run.input_records))
+            self.assertTrue(all(event.sell_unclaimed_volume == 0 for event in run.sell_events
+                                if event.sell_asset != 'AUD'))
+
+    def test_compare_to_baseline(self):
+        baseline = {'sizes': {'1000': {'matching': {'seconds': 1.0, 'peak_bytes': 100}}}}
+        results = {'sizes': {'1000': {'matching': {'seconds': 1.2, 'peak_bytes': 200}}}}
+        regressions = bench.compare_to_baseline(results, baseline, 0.25)
+        self.assertEqual(1, len(regressions))
+        self.assertIn("peak_bytes", regressions[0])
+
+    def test_compare_to_baseline_floor(self):
+        baseline = {'sizes': {'1000': {'pricing': {'seconds': 0.001, 'peak_bytes': None}}}}
+        results = {'sizes': {'1000': {'pricing': {'seconds': 0.004, 'peak_bytes': None}}}}
+        self.assertEqual(1, len(bench.compare_to_baseline(results, baseline, 0.25)))
+        self.assertEqual([], bench.compare_to_baseline(results, baseline, 0.25, min_seconds=0.05))
+
+    def test_generated_trades_start_with_most_assets(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "bench.csv")
+            bench.generate_trades(file_name, 1000, seed=1)
+            with open(file_name) as csvfile:
+                rows = list(csv.DictReader(csvfile))
+        usdt = sum(1 for row in rows if 'USDT' in (row['buy_asset'], row['sell_asset']))
+        self.assertLess(usdt, len(rows) / 4)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
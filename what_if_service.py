@@ -0,0 +1,365 @@
+import os
+import csv
+import json
+import logging
+import argparse
+import datetime
+import collections
+import socketserver
+import http.server
+import urllib.parse
+from decimal import Decimal, InvalidOperation
+import price_tools
+import lot_matching
+import tax_my_shit_up
+
+
+class WhatIfState:
+    """ One portfolio held in memory between queries: its TaxRun, the open buy lots of each asset, and how far each
+    input file has been read. Trades appended to the input files are read, priced and matched by refresh, with the
+    same semantics as a run carrying on from a snapshot; matches already made are final, and new sells only claim
+    what the buys have left """
+    def __init__(self, input_dir, strategy="default", workers=0, snapshot_in=None):
+        self.run = tax_my_shit_up.TaxRun(input_dir)
+        self.strategy = strategy
+        self.workers = workers
+        self.since = None  # trades on or before this date are covered by the snapshot
+        self.input_files = dict()  # file name -> (header fieldnames, bytes read)
+        self.open_lots = dict()  # asset -> list of lot_matching.Lot with unclaimed volume, in date order
+        self.last_refresh_error = None  # why the latest refresh failed, while queries are answered from before it
+        if snapshot_in:
+            self.since = tax_my_shit_up.load_snapshot(self.run, snapshot_in)
+        self.refresh(whole_lines_only=False)
+
+    def refresh(self, whole_lines_only=True):
+        """ Read the trades appended to the input files since the last refresh, price them and match their sells
+        against the open lots. A last line without a line break may still be being written, so it is left for a
+        later refresh, unless whole_lines_only is False as it is when the files are first read. Nothing is kept
+        unless every new trade parses and prices, so a refresh which fails is tried again in full by the next one.
+        Returns the number of records added """
+        rows = list()
+        read_to = dict()
+        for file_name in tax_my_shit_up.list_input_files(self.run.input_dir):
+            fieldnames, end, file_rows = self.read_appended_rows(file_name, whole_lines_only)
+            if fieldnames is not None:
+                read_to[file_name] = (fieldnames, end)
+            rows.extend(file_rows)
+        if self.since is not None:
+            rows = [row for row in rows if row['date'] > self.since]
+        if not rows:
+            self.input_files.update(read_to)
+            return 0
+
+        sell_count = len(self.run.sell_events)
+        input_records = self.price_rows(rows)
+        self.run.input_records.extend(input_records)
+        self.input_files.update(read_to)
+        tax_my_shit_up.do_calc_gains(self.run, self.strategy, self.workers, self.run.sell_events[sell_count:])
+        self.index_open_lots()
+        logging.debug("applied %s new records, %s open lots" % (len(input_records), self.open_lot_count()))
+        return len(input_records)
+
+    def try_refresh(self):
+        """ refresh before a query. A trade which can't be read or priced fails every refresh until the input is
+        fixed, so rather than failing every query the error is kept for status and queries are answered from the
+        last state which refreshed """
+        try:
+            self.refresh()
+        except Exception as e:
+            if str(e) != self.last_refresh_error:
+                logging.error("refresh failed, answering from the last good state: %s" % e)
+            self.last_refresh_error = str(e)
+        else:
+            self.last_refresh_error = None
+
+    def price_rows(self, rows):
+        """ Return the input records of rows, with their buy and sell events added to the run. If any of them fails,
+        the run is left as it was, ids included """
+        run = self.run
+        counters = (run.input_counter, run.buy_event_counter, run.sell_event_counter)
+        buy_count, sell_count = len(run.buy_events), len(run.sell_events)
+        try:
+            input_records = tax_my_shit_up.rows_to_input_records(run, rows)
+            tax_my_shit_up.price_input_records(run, input_records)
+        except Exception:
+            run.input_counter, run.buy_event_counter, run.sell_event_counter = counters
+            del run.buy_events[buy_count:]
+            del run.sell_events[sell_count:]
+            raise
+        return input_records
+
+    def read_appended_rows(self, file_name, whole_lines_only=True):
+        """ Return the header fieldnames of file_name, the offset it has been read to and the parsed rows after the
+        bytes read so far. The offset is not stored, refresh does that once the rows have been applied """
+        fieldnames, offset = self.input_files.get(file_name, (None, 0))
+        size = os.path.getsize(file_name)
+        if size < offset:
+            logging.error("%s is shorter than when it was read, only appended trades are picked up" % file_name)
+            return fieldnames, offset, []
+
+        with open(file_name, 'rb') as input_file:
+            if fieldnames is None:
+                header = input_file.readline()
+                if not header.endswith(b"\n"):
+                    return None, 0, []
+                fieldnames = next(csv.reader([header.decode('utf-8-sig')]))
+                offset = input_file.tell()
+            input_file.seek(offset)
+            appended = input_file.read(size - offset)
+
+        end = offset + (tax_my_shit_up.whole_rows_length(appended) if whole_lines_only else len(appended))
+        if end == offset:
+            return fieldnames, end, []
+        return fieldnames, end, tax_my_shit_up.parse_input_chunk(file_name, fieldnames, offset, end)
+
+    def index_open_lots(self):
+        buy_events = [buy_event for buy_event in self.run.buy_events
+                      if buy_event.buy_unclaimed_volume != 0 and buy_event.buy_asset not in ['AUD']]
+        lots, sells = tax_my_shit_up.events_to_lots(buy_events, [])
+        self.open_lots = dict()
+        for lot in sorted(lots, key=lambda lot: lot.date):
+            self.open_lots.setdefault(lot.asset, []).append(lot)
+
+    def open_lot_count(self):
+        return sum(len(lots) for lots in self.open_lots.values())
+
+    def hypothetical_sell(self, asset, volume, date, price_aud=None, strategy=None):
+        """ Return what selling volume of asset on date would claim from the open lots, and the capital gain it
+        would make, without changing anything. price_aud defaults to the price on date """
+        asset = asset.upper()
+        if not volume.is_finite() or volume <= 0:
+            raise ValueError("volume must be more than 0, not %s" % volume)
+        if price_aud is None:
+            price_aud = price_tools.get_price_at_datetime(asset, date)
+        strategy = strategy or self.strategy
+        sell = lot_matching.Sell(None, date, asset, price_aud, volume)
+        claims = lot_matching.match_lots(strategy, self.open_lots.get(asset, []), [sell])
+
+        result = collections.OrderedDict()
+        result['asset'] = asset
+        result['volume'] = volume
+        result['date'] = date
+        result['price_aud'] = price_aud
+        result['strategy'] = strategy
+        result['unmatched_volume'] = volume - sum((claimed for sell, lot, claimed in claims), Decimal(0))
+        result.update(lot_matching.summarise_claims(claims))
+        result['lots'] = [lot_summary(lot, date, claimed, price_aud) for sell, lot, claimed in claims]
+        return result
+
+    def unrealised_gains(self, date, asset=None):
+        """ Return the value of the lots open on date against their cost base, for each asset or just asset """
+        totals = collections.OrderedDict((name, Decimal(0)) for name in
+                                         ['cost_base_aud', 'value_aud', 'gain', 'discountable_gain'])
+        assets = collections.OrderedDict()
+        for lot_asset in ([asset] if asset else sorted(self.open_lots)):
+            lots = [lot for lot in self.open_lots.get(lot_asset, []) if lot.date <= date]
+            if not lots:
+                continue
+            try:
+                price_aud = price_tools.get_price_at_datetime(lot_asset, date)
+            except price_tools.PriceLookupError as e:
+                if asset:
+                    raise
+                assets[lot_asset] = {'error': str(e)}
+                continue
+
+            summary = collections.OrderedDict()
+            summary['lots'] = len(lots)
+            summary['volume'] = sum((lot.volume for lot in lots), Decimal(0))
+            summary['discountable_volume'] = sum((lot.volume for lot in lots
+                                                  if lot_matching.is_cgt_discounted(date, lot.date)), Decimal(0))
+            summary['price_aud'] = price_aud
+            summary['cost_base_aud'] = sum((lot.price_aud * lot.volume for lot in lots), Decimal(0))
+            summary['value_aud'] = price_aud * summary['volume']
+            summary['gain'] = summary['value_aud'] - summary['cost_base_aud']
+            summary['discountable_gain'] = sum((max((price_aud - lot.price_aud) * lot.volume, Decimal(0)) for lot in lots
+                                                if lot_matching.is_cgt_discounted(date, lot.date)), Decimal(0))
+            for name in totals:
+                totals[name] += summary[name]
+            assets[lot_asset] = summary
+
+        result = collections.OrderedDict()
+        result['date'] = date
+        result['assets'] = assets
+        result['totals'] = totals
+        return result
+
+    def lots(self, date, asset=None, discounted_only=False):
+        """ Return the lots open on date, with how long each has been held, optionally only those held long enough
+        for the CGT discount """
+        lots = list()
+        for lot_asset in ([asset] if asset else sorted(self.open_lots)):
+            for lot in self.open_lots.get(lot_asset, []):
+                if lot.date > date:
+                    break
+                if discounted_only and not lot_matching.is_cgt_discounted(date, lot.date):
+                    continue
+                lots.append(lot_summary(lot, date))
+        return {'date': date, 'lots': lots}
+
+    def status(self):
+        result = collections.OrderedDict()
+        result['input_dir'] = self.run.input_dir
+        result['strategy'] = self.strategy
+        result['snapshot_date'] = self.since
+        result['input_records'] = len(self.run.input_records)
+        result['open_lots'] = self.open_lot_count()
+        result['last_refresh_error'] = self.last_refresh_error
+        result['input_files'] = dict((file_name, offset) for file_name, (fieldnames, offset) in self.input_files.items())
+        return result
+
+
+def lot_summary(lot, date, volume=None, price_aud=None):
+    """ A json ready description of a lot as of date. Given the volume a sell would claim at price_aud, the gain it
+    would make is included """
+    summary = collections.OrderedDict()
+    summary['id'] = lot.id
+    summary['date'] = lot.date
+    summary['volume'] = lot.volume if volume is None else volume
+    summary['price_aud'] = lot.price_aud
+    summary['days_held'] = lot_matching.days_held(date, lot.date)
+    summary['cgt_discount'] = lot_matching.is_cgt_discounted(date, lot.date)
+    if price_aud is not None:
+        summary['gain'] = (price_aud - lot.price_aud) * volume
+    return summary
+
+
+def required(query, name):
+    if not query.get(name):
+        raise ValueError("%s is required" % name)
+    return query[name]
+
+
+def parse_query_date(query):
+    """ The date query parameter as an ISO date, with a time of day for intraday prices, defaulting to today """
+    if not query.get('date'):
+        return datetime.datetime.combine(datetime.date.today(), datetime.time())
+    return datetime.datetime.fromisoformat(query['date'])
+
+
+def parse_query_decimal(query, name):
+    try:
+        value = Decimal(query[name])
+    except InvalidOperation:
+        raise ValueError("%s is not a number: %r" % (name, query[name]))
+    if not value.is_finite():
+        raise ValueError("%s must be a finite number: %r" % (name, query[name]))
+    return value
+
+
+def parse_query_asset(query):
+    """ The asset query parameter, if given, upper-cased like the asset names of the input files """
+    return query['asset'].upper() if query.get('asset') else None
+
+
+def query_sell(state, query):
+    price_aud = parse_query_decimal(query, 'price') if query.get('price') else None
+    strategy = query.get('strategy')
+    if strategy is not None and strategy not in lot_matching.STRATEGIES:
+        raise ValueError("unknown strategy %r" % strategy)
+    required(query, 'asset')
+    required(query, 'volume')
+    return state.hypothetical_sell(parse_query_asset(query), parse_query_decimal(query, 'volume'),
+                                   parse_query_date(query), price_aud, strategy)
+
+
+def query_unrealised(state, query):
+    return state.unrealised_gains(parse_query_date(query), parse_query_asset(query))
+
+
+def query_lots(state, query):
+    return state.lots(parse_query_date(query), parse_query_asset(query), query.get('discounted') in ['1', 'true'])
+
+
+def query_status(state, query):
+    return state.status()
+
+
+ROUTES = {
+    '/sell': query_sell,
+    '/unrealised': query_unrealised,
+    '/lots': query_lots,
+    '/status': query_status,
+}
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)  # Decimal, exactly
+
+
+class WhatIfHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers GET requests for ROUTES with json, applying any appended trades first. The server handles one request
+    at a time, so the state is never read while it is being refreshed """
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        route = ROUTES.get(url.path)
+        if route is None:
+            self.send_json(404, {'error': "unknown path %s, try one of %s" % (url.path, ", ".join(sorted(ROUTES)))})
+            return
+
+        self.server.state.try_refresh()
+        try:
+            result = route(self.server.state, dict(urllib.parse.parse_qsl(url.query)))
+        except (ValueError, KeyError, ArithmeticError) as e:
+            # PriceLookupError is a KeyError, and decimal errors such as InvalidOperation are ArithmeticErrors
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, result)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=json_default).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """ Serves an http.server handler on a Unix socket rather than a TCP port """
+
+
+def make_server(state, port=None, unix_socket=None, host="127.0.0.1"):
+    """ Return a server answering queries about state, on unix_socket if it is given or on host:port otherwise """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)  # left by a server which was killed
+        server = UnixHTTPServer(unix_socket, WhatIfHandler)
+    else:
+        server = http.server.HTTPServer((host, port), WhatIfHandler)
+    server.state = state
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Answer what-if capital gains queries about a portfolio held in memory")
+    parser.add_argument("--input-dir", default="input/", help="directory of input trade csv files")
+    parser.add_argument("--load-snapshot", help="carry on from a snapshot saved by an earlier run, reading only later trades")
+    parser.add_argument("--strategy", default="default", choices=list(lot_matching.STRATEGIES),
+                        help="how sells are matched with buy lots")
+    parser.add_argument("--workers", type=int, default=0, help="processes to match assets with on start up")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on, on localhost only")
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of a port")
+    args = parser.parse_args()
+
+    price_tools.preload()
+    server = make_server(WhatIfState(args.input_dir, args.strategy, args.workers, args.load_snapshot),
+                         args.port, args.unix_socket)
+    logging.info("answering queries on %s" % (args.unix_socket or "http://127.0.0.1:%s/" % args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket:
+            os.remove(args.unix_socket)